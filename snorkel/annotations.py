@@ -5,41 +5,181 @@ from __future__ import unicode_literals
 from builtins import *
 from future.utils import iteritems
 
+from collections import defaultdict
+from hashlib import md5, sha1
+from multiprocessing import Pool
+from tempfile import TemporaryFile, mkdtemp
+import os
+import shutil
+import struct
+
 import numpy as np
-from pandas import DataFrame, Series
+from pandas import DataFrame, Series, read_csv
 import scipy.sparse as sparse
-from sqlalchemy.sql import bindparam, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import selectinload, with_polymorphic
+from sqlalchemy.sql import and_, bindparam, cast, func, select, text
+from sqlalchemy.types import BigInteger, Float
 
 from snorkel.features import get_span_feats
 from snorkel.models import (
     GoldLabel, GoldLabelKey, Label, LabelKey, Feature, FeatureKey, Candidate,
-    Marginal
-)
-from snorkel.models.meta import new_sessionmaker
-from snorkel.udf import UDF, UDFRunner
-from snorkel.utils import (
-    matrix_conflicts,
-    matrix_coverage,
-    matrix_overlaps,
-    matrix_tp,
-    matrix_fp,
-    matrix_fn,
-    matrix_tn
+    Marginal, Context, Sentence, Span
 )
+from snorkel.models.meta import get_engine, new_sessionmaker, snorkel_conn_string, snorkel_postgres, write_scope
+from snorkel.udf import UDF, UDFRunner, Row, WriteBuffer, chunks, config_hash
+from snorkel.utils import label_matrix_stats
+
+
+class IdIndex(object):
+    """
+    A dict-like map from the row (or column) positions of an annotation matrix to candidate (or
+    annotation key) ids, backed by an array of the ids
+    """
+    def __init__(self, ids):
+        self.ids = np.asarray(ids, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, i):
+        return isinstance(i, (int, np.integer)) and 0 <= i < len(self.ids)
+
+    def __getitem__(self, i):
+        if i not in self:
+            raise KeyError(i)
+        return int(self.ids[i])
+
+    def __iter__(self):
+        return iter(range(len(self.ids)))
+
+    def __eq__(self, other):
+        if isinstance(other, IdIndex):
+            return np.array_equal(self.ids, other.ids)
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get(self, i, default=None):
+        return self[i] if i in self else default
+
+    def keys(self):
+        return list(range(len(self.ids)))
+
+    def values(self):
+        return self.ids.tolist()
+
+    def items(self):
+        return list(enumerate(self.ids.tolist()))
+
+    def take(self, idxs):
+        """Returns the IdIndex of the rows (or columns) idxs"""
+        return IdIndex(self.ids[idxs])
+
+
+class InverseIdIndex(object):
+    """
+    A dict-like map from candidate (or annotation key) ids to the row (or column) positions of an
+    annotation matrix, backed by an array of the ids. Ids are looked up by binary search over a sorted
+    copy of the ids, which is only made if they are not already sorted.
+    """
+    def __init__(self, ids):
+        self.ids     = np.asarray(ids, dtype=np.int64)
+        self._order  = None
+        self._sorted = None
+
+    def _sort(self):
+        if self._sorted is None:
+            if np.all(self.ids[1:] > self.ids[:-1]):
+                self._sorted = self.ids
+            else:
+                self._order  = np.argsort(self.ids, kind='mergesort')
+                self._sorted = self.ids[self._order]
+
+    def lookup(self, ids):
+        """Returns the positions of an array of ids, with -1 for ids which are not in the index"""
+        self._sort()
+        ids  = np.asarray(ids, dtype=np.int64)
+        idxs = np.searchsorted(self._sorted, ids)
+        idxs[idxs == len(self._sorted)] = 0
+        found = (self._sorted[idxs] == ids) if len(self._sorted) > 0 else np.zeros(ids.shape, dtype=bool)
+        if self._order is not None:
+            idxs = self._order[idxs]
+        return np.where(found, idxs, -1)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _position(self, k):
+        if not isinstance(k, (int, np.integer)):
+            return -1
+        self._sort()
+        i = int(self._sorted.searchsorted(k))
+        if i == len(self._sorted) or self._sorted[i] != k:
+            return -1
+        return i if self._order is None else int(self._order[i])
+
+    def __contains__(self, k):
+        return self._position(k) >= 0
+
+    def __getitem__(self, k):
+        i = self._position(k)
+        if i < 0:
+            raise KeyError(k)
+        return i
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __eq__(self, other):
+        if isinstance(other, InverseIdIndex):
+            return np.array_equal(self.ids, other.ids)
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get(self, k, default=None):
+        return self[k] if k in self else default
+
+    def keys(self):
+        return self.ids.tolist()
+
+    def values(self):
+        return list(range(len(self.ids)))
+
+    def items(self):
+        return list(zip(self.ids.tolist(), range(len(self.ids))))
+
+
+def _id_indexes(index, inv_index):
+    """Returns index and inv_index as an IdIndex and InverseIdIndex, converting them from dicts"""
+    if index is None:
+        return None, inv_index
+    if not isinstance(index, IdIndex):
+        index = IdIndex([index[i] for i in range(len(index))] if isinstance(index, dict) else index)
+    if not isinstance(inv_index, InverseIdIndex):
+        inv_index = InverseIdIndex(index.ids)
+    return index, inv_index
 
 
 class csr_AnnotationMatrix(sparse.csr_matrix):
     """
     An extension of the scipy.sparse.csr_matrix class for holding sparse annotation matrices
     and related helper methods.
+
+    The candidate and annotation key ids of the rows and columns are kept in an IdIndex (row_index and
+    col_index) and an InverseIdIndex (candidate_index and key_index), which can be used as dicts.
+    They can be passed as arrays of ids, or as dicts.
     """
     def __init__(self, arg1, **kwargs):
         # Note: Currently these need to return None if unset, otherwise matrix copy operations break...
-        self.candidate_index    = kwargs.pop('candidate_index', None)
-        self.row_index          = kwargs.pop('row_index', None)
+        self.row_index, self.candidate_index = _id_indexes(kwargs.pop('row_index', None),
+                                                           kwargs.pop('candidate_index', None))
         self.annotation_key_cls = kwargs.pop('annotation_key_cls', None)
-        self.key_index          = kwargs.pop('key_index', None)
-        self.col_index          = kwargs.pop('col_index', None)
+        self.col_index, self.key_index = _id_indexes(kwargs.pop('col_index', None),
+                                                     kwargs.pop('key_index', None))
 
         # Note that scipy relies on the first three letters of the class to define matrix type...
         super(csr_AnnotationMatrix, self).__init__(arg1, **kwargs)
@@ -48,6 +188,19 @@ class csr_AnnotationMatrix(sparse.csr_matrix):
         """Return the Candidate object corresponding to row i"""
         return session.query(Candidate).filter(Candidate.id == self.row_index[i]).one()
 
+    def get_candidates(self, session, rows=None):
+        """
+        Return the Candidate objects corresponding to rows (default: all rows), in order, loading them
+        with one query per PREFETCH_BATCH_SIZE candidates and Candidate subclass
+        """
+        cids       = self.get_candidate_ids(rows)
+        candidates = load_candidates(session, cids)
+        return [candidates[cid] for cid in cids.tolist()]
+
+    def get_candidate_ids(self, rows=None):
+        """Return the array of Candidate ids corresponding to rows (default: all rows), without querying"""
+        return self.row_index.ids if rows is None else self.row_index.ids[rows]
+
     def get_row_index(self, candidate):
         """Return the row index of the Candidate"""
         return self.candidate_index[candidate.id]
@@ -57,6 +210,15 @@ class csr_AnnotationMatrix(sparse.csr_matrix):
         return session.query(self.annotation_key_cls)\
                 .filter(self.annotation_key_cls.id == self.col_index[j]).one()
 
+    def get_keys(self, session, cols=None):
+        """Return the AnnotationKey objects corresponding to cols (default: all columns), in order"""
+        kids = self.col_index.ids if cols is None else self.col_index.ids[cols]
+        keys = {}
+        for batch in chunks(kids.tolist(), PREFETCH_BATCH_SIZE):
+            for key in session.query(self.annotation_key_cls).filter(self.annotation_key_cls.id.in_(batch)):
+                keys[key.id] = key
+        return [keys[kid] for kid in kids.tolist()]
+
     def get_col_index(self, key):
         """Return the cow index of the AnnotationKey"""
         return self.key_index[key.id]
@@ -67,33 +229,34 @@ class csr_AnnotationMatrix(sparse.csr_matrix):
         Note: This becomes a massive performance bottleneck if not implemented
         properly, so be careful of changing!
         """
+        if index is None:
+            return index, inv_index
         if isinstance(s, slice):
             # Check for empty slice
-            if s.start is None and s.stop is None:
+            if s.start is None and s.stop is None and s.step is None:
                 return index, inv_index
             else:
                 idxs = np.arange(self.shape[axis])[s]
-        elif isinstance(s, int):
+        elif isinstance(s, (int, np.integer)):
             idxs = np.array([s])
-        else: # s is an array of ints
-            idxs = s
+        else: # s is an array of ints, or a boolean mask
+            idxs = np.asarray(s)
+            if idxs.dtype == bool:
+                idxs = np.flatnonzero(idxs)
             # If s is the entire slice, skip the remapping step
-            if np.array_equal(idxs, list(range(len(idxs)))):
+            if len(idxs) == self.shape[axis] and np.array_equal(idxs, np.arange(len(idxs))):
                 return index, inv_index
 
-        index_new, inv_index_new = {}, {}
-        for i_new, i in enumerate(idxs):
-            k = index[i]
-            index_new[i_new] = k
-            inv_index_new[k] = i_new
-        return index_new, inv_index_new
+        # The new indexes share the array of ids; the inverse index is only sorted when first used
+        index_new = index.take(idxs.ravel())
+        return index_new, InverseIdIndex(index_new.ids)
 
     def __getitem__(self, key):
         X = super(csr_AnnotationMatrix, self).__getitem__(key)
 
         # If X is an integer or float value, just return it
         if type(X) in [int, float] or issubclass(type(X), np.integer)\
-            or issubclass(type(X), np.float):
+            or issubclass(type(X), np.floating):
             return X
         # If X is a matrix, make sure it stays a csr_AnnotationMatrix
         elif not isinstance(X, csr_AnnotationMatrix):
@@ -115,25 +278,26 @@ class csr_AnnotationMatrix(sparse.csr_matrix):
 try:
     class csr_LabelMatrix(csr_AnnotationMatrix):
 
-        def lf_stats(self, session, labels=None, est_accs=None):
-            """Returns a pandas DataFrame with the LFs and various per-LF statistics"""
-            lf_names = [self.get_key(session, j).name for j in range(self.shape[1])]
+        def lf_stats(self, session, labels=None, est_accs=None, n_threads=1):
+            """
+            Returns a pandas DataFrame with the LFs and various per-LF statistics, computed in a single
+            pass over the matrix (by n_threads threads)
+            """
+            lf_names = [key.name for key in self.get_keys(session)]
+            stats    = label_matrix_stats(self, labels=labels, n_threads=n_threads)
+            n        = float(self.shape[0])
 
             # Default LF stats
             col_names = ['j', 'Coverage', 'Overlaps', 'Conflicts']
             d = {
                 'j'         : list(range(self.shape[1])),
-                'Coverage'  : Series(data=matrix_coverage(self), index=lf_names),
-                'Overlaps'  : Series(data=matrix_overlaps(self), index=lf_names),
-                'Conflicts' : Series(data=matrix_conflicts(self), index=lf_names)
+                'Coverage'  : Series(data=stats['coverage'] / n, index=lf_names),
+                'Overlaps'  : Series(data=stats['overlaps'] / n, index=lf_names),
+                'Conflicts' : Series(data=stats['conflicts'] / n, index=lf_names)
             }
             if labels is not None:
                 col_names.extend(['TP', 'FP', 'FN', 'TN', 'Empirical Acc.'])
-                ls = np.ravel(labels.todense() if sparse.issparse(labels) else labels)
-                tp = matrix_tp(self, ls)
-                fp = matrix_fp(self, ls)
-                fn = matrix_fn(self, ls)
-                tn = matrix_tn(self, ls)
+                tp, fp, fn, tn = stats['tp'], stats['fp'], stats['fn'], stats['tn']
                 ac = (tp+tn) / (tp+tn+fp+fn)
                 d['Empirical Acc.'] = Series(data=ac, index=lf_names)
                 d['TP']             = Series(data=tp, index=lf_names)
@@ -156,18 +320,26 @@ except:
 
 class Annotator(UDFRunner):
     """Abstract class for annotating candidates and persisting these annotations to DB"""
-    def __init__(self, annotation_class, annotation_key_class, f_gen):
+    def __init__(self, annotation_class, annotation_key_class, f_gen, udf_class=None, **udf_init_kwargs):
         self.annotation_class     = annotation_class
         self.annotation_key_class = annotation_key_class
-        super(Annotator, self).__init__(AnnotatorUDF,
+        super(Annotator, self).__init__(udf_class or AnnotatorUDF,
                                         annotation_class=annotation_class,
                                         annotation_key_class=annotation_key_class,
-                                        f_gen=f_gen)
+                                        f_gen=f_gen, **udf_init_kwargs)
 
-    def apply(self, split=0, key_group=0, replace_key_set=True, cids_query=None,
+    def apply(self, split=0, key_group=0, replace_key_set=True, cids_query=None, group_by=None,
         **kwargs):
+        """
+        Annotates the Candidates of split (or of cids_query), and returns their annotation matrix.
+
+        :param group_by: If 'sentence' or 'document', the Candidates are annotated in order of the parent
+            Sentence or Document of their first argument, so that the Candidates of each context are
+            in the same chunks and share the per-context work cached by the annotation functions (e.g.
+            parse trees and n-gram counts), rather than in order of id
+        """
         # If we are replacing the key set, make sure the reducer key id cache is cleared!
-        if replace_key_set:
+        if replace_key_set and self.reducer is not None:
             self.reducer.key_cache = {}
 
         # Get the cids based on the split, and also the count
@@ -176,14 +348,17 @@ class Annotator(UDFRunner):
         cids_query = cids_query or session.query(Candidate.id)\
                                           .filter(Candidate.split == split)
 
-        # Note: In the current UDFRunner implementation, we load all these into memory and fill a
-        # multiprocessing JoinableQueue with them before starting... so might as well load them here and pass in.
-        # Also, if we try to pass in a query iterator instead, with AUTOCOMMIT on, we get a TXN error...
-        cids       = cids_query.all()
-        cids_count = len(cids)
+        # Note: The UDFRunner streams the query results to the UDFs, so we only need the count here
+        cids_count = cids_query.count()
+        xs         = cids_query if group_by is None else group_candidates(session, cids_query, group_by)
+
+        # If the key set is not cleared, or we are resuming, we load the existing keys into the cache
+        if self.reducer is not None and \
+            (not replace_key_set or not kwargs.get('clear', True) or kwargs.get('resume', False)):
+            self.reducer.load_key_cache(session, key_group)
 
         # Run the Annotator
-        super(Annotator, self).apply(cids, split=split, key_group=key_group,
+        super(Annotator, self).apply(xs, split=split, key_group=key_group,
             replace_key_set=replace_key_set, cids_query=cids_query,
             count=cids_count, **kwargs)
 
@@ -191,6 +366,10 @@ class Annotator(UDFRunner):
         return self.load_matrix(session, split=split, cids_query=cids_query,
             key_group=key_group)
 
+    def get_run_name(self, split=0, key_group=0, **kwargs):
+        return "%s(split=%s, key_group=%s)[%s]" % (self.__class__.__name__, split, key_group,
+                                                   config_hash(self.get_config()))
+
     def clear(self, session, split=0, key_group=0, replace_key_set=True,
         cids_query=None, **kwargs):
         """
@@ -208,11 +387,13 @@ class Annotator(UDFRunner):
             query = query.filter(self.annotation_class.candidate_id.in_(sub_query))
         query.delete(synchronize_session='fetch')
 
-        # If we are creating a new key set, delete all old annotation keys
+        # If we are creating a new key set, delete all old annotation keys, including any cached by the reducer
         if replace_key_set:
             query = session.query(self.annotation_key_class)
             query = query.filter(self.annotation_key_class.group == key_group)
             query.delete(synchronize_session='fetch')
+            if self.reducer is not None:
+                self.reducer.key_cache = {}
 
     def apply_existing(self, split=0, key_group=0, cids_query=None, **kwargs):
         """Alias for apply that emphasizes we are using an existing AnnotatorKey set."""
@@ -224,7 +405,142 @@ class Annotator(UDFRunner):
         raise NotImplementedError()
 
 
+# Maximum number of ids per IN clause, e.g. when loading Candidates, within the limit on query parameters of SQLite
+PREFETCH_BATCH_SIZE = 500
+
+
+def load_candidates(session, cids):
+    """
+    Returns a dict of the Candidates with ids cids, loaded with one query per PREFETCH_BATCH_SIZE cids and
+    Candidate subclass, along with their argument Contexts (of any type) and the Sentences of Span arguments
+    """
+    candidates = {}
+    contexts   = with_polymorphic(Context, '*')
+    for batch in chunks((int(cid) for cid in cids), PREFETCH_BATCH_SIZE):
+        types = session.query(Candidate.type).filter(Candidate.id.in_(batch)).distinct()
+        for candidate_type, in types.all():
+            candidate_class = Candidate.__mapper__.polymorphic_map[candidate_type].class_
+            options = [
+                selectinload(getattr(candidate_class, arg).of_type(contexts)).joinedload(contexts.Span.sentence)
+                for arg in candidate_class.__argnames__
+            ]
+            q = session.query(candidate_class).options(*options).filter(candidate_class.id.in_(batch))
+            for c in q:
+                candidates[c.id] = c
+    return candidates
+
+
+def group_candidates(session, cids_query, group_by):
+    """
+    Returns the ids of the Candidates of cids_query as (id,) tuples, as the query yields them, ordered by
+    the id of the parent 'sentence' or 'document' of their first argument, and then by id. Candidates
+    whose first argument is not a Span come last.
+    """
+    if group_by not in ('sentence', 'document'):
+        raise ValueError("group_by must be 'sentence' or 'document', not %r." % (group_by,))
+    cids = np.fromiter((cid for cid, in cids_query), dtype=np.int64)
+
+    # The parent contexts are queried for each Candidate subclass, by the id column of its first argument
+    cids_sub  = cids_query.subquery()
+    groups    = {}
+    types     = session.query(Candidate.type).filter(Candidate.id.in_(cids_sub)).distinct()
+    for candidate_type, in types.all():
+        candidate_class = Candidate.__mapper__.polymorphic_map[candidate_type].class_
+        arg_id          = getattr(candidate_class, candidate_class.__argnames__[0] + '_id')
+        q = session.query(candidate_class.id, Sentence.document_id, Span.sentence_id)\
+                   .join(Span, Span.id == arg_id).join(Sentence, Sentence.id == Span.sentence_id)\
+                   .filter(candidate_class.id.in_(cids_sub))
+        for cid, document_id, sentence_id in q:
+            groups[cid] = (document_id, sentence_id)
+    last      = (np.iinfo(np.int64).max, np.iinfo(np.int64).max)
+    keys      = np.array([groups.get(cid, last) for cid in cids.tolist()], dtype=np.int64).reshape(-1, 2)
+    if group_by == 'sentence':
+        order = np.lexsort((cids, keys[:, 1]))
+    else:
+        order = np.lexsort((cids, keys[:, 1], keys[:, 0]))
+    return [(cid,) for cid in cids[order].tolist()]
+
+
+# Number of annotation rows fetched at a time by load_matrix
+LOAD_MATRIX_FETCH_SIZE = 100000
+
+# Number of marginals per batch inserted by save_marginals
+MARGINALS_BATCH_SIZE = 10000
+
+# Version of the on-disk matrix cache layout; bump to invalidate all existing caches
+MATRIX_CACHE_VERSION = 2
+
+# Prime modulus of the per-annotation hashes summed by the matrix cache fingerprint, and the multipliers
+# of the two hashes, see _matrix_cache_path. All intermediate products fit in 64 bit integers
+CHECKSUM_MODULUS     = 2147483647
+CHECKSUM_MULTIPLIERS = [(48271, 69621, 16807, 39373, 1103515245), (40692, 40014, 950706376, 742938285, 1583458089)]
+
+# Scale of the annotation values hashed by the matrix cache fingerprint, so that float values are
+# hashed to a precision of 1e-6
+CHECKSUM_VALUE_SCALE = 1000000
+
+
+class AnnotationWriteBuffer(WriteBuffer):
+    """
+    A WriteBuffer which can also upsert Annotations, i.e. set the values of existing ones and insert the
+    others, in bulk
+    """
+    def __init__(self, session, **kwargs):
+        super(AnnotationWriteBuffer, self).__init__(session, **kwargs)
+        self.upserts = defaultdict(list)
+
+    def upsert(self, annotation_class, candidate_id, key_id, value):
+        self.upserts[annotation_class].append({'cid': candidate_id, 'kid': key_id, 'value': value})
+
+    def __len__(self):
+        return len(self.rows) + sum(len(upserts) for upserts in self.upserts.values())
+
+    def mark(self):
+        return super(AnnotationWriteBuffer, self).mark(), \
+            dict((cls, len(upserts)) for cls, upserts in iteritems(self.upserts))
+
+    def discard(self, mark):
+        rows_mark, upserts_mark = mark
+        super(AnnotationWriteBuffer, self).discard(rows_mark)
+        for cls, upserts in iteritems(self.upserts):
+            del upserts[upserts_mark.get(cls, 0):]
+
+    def write(self):
+        n = 0
+        for annotation_class, upserts in iteritems(self.upserts):
+            self._upsert(annotation_class, upserts)
+            n += len(upserts)
+        self.upserts = defaultdict(list)
+        return n + super(AnnotationWriteBuffer, self).write()
+
+    def _upsert(self, annotation_class, upserts):
+        table = annotation_class.__table__
+
+        # As for a single Annotation, a zero value only updates an existing Annotation
+        updates = [u for u in upserts if u['value'] == 0]
+        if len(updates) > 0:
+            update = table.update().where(and_(table.c.candidate_id == bindparam('cid'),
+                                               table.c.key_id == bindparam('kid')))
+            self.session.execute(update.values(value=bindparam('value')), updates)
+
+        inserts = [{'candidate_id': u['cid'], 'key_id': u['kid'], 'value': u['value']}
+                   for u in upserts if u['value'] != 0]
+        if len(inserts) == 0:
+            return
+        if snorkel_postgres:
+            insert = postgresql.insert(table)
+            insert = insert.on_conflict_do_update(index_elements=[table.c.candidate_id, table.c.key_id],
+                                                  set_={'value': insert.excluded.value})
+        elif snorkel_conn_string.startswith('sqlite'):
+            insert = table.insert().prefix_with('OR REPLACE')
+        else:
+            raise NotImplementedError("Upserting Annotations is only supported with PostgreSQL and SQLite.")
+        self.session.execute(insert, inserts)
+
+
 class AnnotatorUDF(UDF):
+    write_buffer_class = AnnotationWriteBuffer
+
     def __init__(self, annotation_class, annotation_key_class, f_gen, **kwargs):
         self.annotation_class     = annotation_class
         self.annotation_key_class = annotation_key_class
@@ -239,8 +555,22 @@ class AnnotatorUDF(UDF):
         # For caching key ids during the reduce step
         self.key_cache = {}
 
+        # The Candidates of the current chunk of cids, see prefetch
+        self.candidates = {}
+
         super(AnnotatorUDF, self).__init__(**kwargs)
 
+    @staticmethod
+    def get_item_id(x):
+        return str(x[0])
+
+    def prefetch(self, cids):
+        """
+        Loads the Candidates of a chunk of cids with one query per PREFETCH_BATCH_SIZE cids and Candidate
+        subclass, along with their argument Contexts (of any type) and the Sentences of Span arguments
+        """
+        self.candidates = load_candidates(self.session, [cid[0] for cid in cids])
+
     def apply(self, cid, **kwargs):
         """
         Applies a given function to a Candidate, yielding a set of Annotations as key_name, value pairs
@@ -250,7 +580,7 @@ class AnnotatorUDF(UDF):
         """
         seen = set()
         cid = cid[0]
-        c    = self.session.query(Candidate).filter(Candidate.id == cid).one()
+        c    = self.candidates.get(cid) or self.session.query(Candidate).filter(Candidate.id == cid).one()
         for key_name, value in self.anno_generator(c):
 
             # Note: Make sure no duplicates emitted here!
@@ -258,149 +588,379 @@ class AnnotatorUDF(UDF):
                 seen.add((cid, key_name))
                 yield cid, key_name, value
 
+    def load_key_cache(self, session, key_group):
+        """Loads the existing AnnotationKeys of key_group (or of all groups, if None) into the key id cache"""
+        keys = session.query(self.annotation_key_class.name, self.annotation_key_class.id)
+        if key_group is not None:
+            keys = keys.filter(self.annotation_key_class.group == key_group)
+        self.key_cache = dict(keys.all())
+
     def reduce(self, y, clear, key_group, replace_key_set, **kwargs):
         """
-        Inserts Annotations into the database.
+        Adds Annotations to the write buffer, to be inserted (or upserted, if clear=False) in bulk.
         For Annotations with unseen AnnotationKeys (in key_group, if not None), either adds these
-        AnnotationKeys if create_new_keyset is True, else skips these Annotations.
+        AnnotationKeys if replace_key_set is True, else skips these Annotations.
+
+        Note: If replace_key_set=False, the existing key set must have been loaded with load_key_cache.
         """
         cid, key_name, value = y
 
-        # Prepares queries
-        # Annoation updating only needs to be done if clear=False
-        if not clear:
-            anno_update_query = self.annotation_class.__table__.update()
-            anno_update_query = anno_update_query.where(self.annotation_class.candidate_id == bindparam('cid'))
-            anno_update_query = anno_update_query.where(self.annotation_class.key_id == bindparam('kid'))
-            anno_update_query = anno_update_query.values(value=bindparam('value'))
-
-        # We only need to insert AnnotationKeys if replace_key_set=True
+        # Check if the AnnotationKey already exists, and gets its id
+        # If we are replacing the AnnotationKeys (replace_key_set=True), then we assume they will
+        # all have been handled by *this* reduce thread, and hence be in the cache already
         # Note that in current configuration, we never update AnnotationKeys!
-        if replace_key_set:
+        key_id = self.key_cache.get(key_name)
+        if key_id is None and replace_key_set:
+            key_args = {'name': key_name, 'group': key_group} if key_group else {'name': key_name}
             key_insert_query = self.annotation_key_class.__table__.insert()
+            key_id = self.session.execute(key_insert_query, key_args).inserted_primary_key[0]
+            self.key_cache[key_name] = key_id
 
-        # If we are replacing the AnnotationKeys (replace_key_set=True), then we assume they will
-        # all have been handled by *this* reduce thread, and hence be in the cache already
-        # So we only need key select queries if replace_key_set=False
-        else:
-            key_select_query = select([self.annotation_key_class.id])\
-                                .where(self.annotation_key_class.name == bindparam('name'))
-            if key_group is not None:
-                key_select_query = key_select_query.where(self.annotation_key_class.group == key_group)
+        # If AnnotationKey does not exist and replace_key_set = False, skip
+        if key_id is not None:
 
-        anno_insert_query = self.annotation_class.__table__.insert()
+            # Annotations may already exist if clear=False, so we upsert them
+            if not clear:
+                self.buffer.upsert(self.annotation_class, cid, key_id, value)
+            elif value != 0:
+                self.buffer.add(Row(self.annotation_class, candidate_id=cid, key_id=key_id, value=value))
 
-        # Check if the AnnotationKey already exists, and gets its id
-        key_id = None
-        if key_name in self.key_cache:
-            key_id = self.key_cache[key_name]
-        else:
-            key_args = {'name': key_name, 'group': key_group} if key_group else {'name': key_name}
 
-            # If we are replacing the AnnotationKeys (replace_key_set=True), then we assume they will
-            # all have been handled by *this* reduce thread, and hence be in the cache already
-            if not replace_key_set:
-                key_id = self.session.execute(key_select_query, key_args).first()
+class HashedAnnotatorUDF(UDF):
+    """
+    Applies a generator of annotations to Candidates, mapping the annotation key names into a fixed
+    set of 2^hash_bits AnnotationKeys with signed feature hashing (see feature_hash). The keys must have
+    been reserved with reserve_hash_keys, so there is no reduce step: the Annotations are written by the
+    UDF processes.
 
-            # Key not in cache but exists in DB; add to cache
-            if key_id is not None:
-                key_id                   = key_id[0]
-                self.key_cache[key_name] = key_id
+    The values of annotations hashed to the same key are summed, and zero sums are dropped.
+    """
+    def __init__(self, annotation_class, annotation_key_class, f_gen, hash_bits, **kwargs):
+        self.annotation_class     = annotation_class
+        self.annotation_key_class = annotation_key_class
+        self.anno_generator       = f_gen
+        self.hash_bits            = hash_bits
+
+        # The ids of the reserved keys of a key group, by hash, loaded on first use
+        self.hash_key_group = None
+        self.hash_key_ids   = None
+
+        # The Candidates of the current chunk of cids, see prefetch
+        self.candidates = {}
+
+        super(HashedAnnotatorUDF, self).__init__(**kwargs)
+
+    @staticmethod
+    def get_item_id(x):
+        return str(x[0])
+
+    def prefetch(self, cids):
+        self.candidates = load_candidates(self.session, [cid[0] for cid in cids])
+
+    def apply(self, cid, key_group=0, **kwargs):
+        if self.hash_key_ids is None or self.hash_key_group != key_group:
+            self.hash_key_ids   = load_hash_key_ids(self.session, self.annotation_key_class, key_group,
+                                                    self.hash_bits)
+            self.hash_key_group = key_group
+        cid    = cid[0]
+        c      = self.candidates.get(cid) or self.session.query(Candidate).filter(Candidate.id == cid).one()
+        seen   = set()
+        values = defaultdict(float)
+        for key_name, value in self.anno_generator(c):
 
-            # Key not in cache or DB; add to both if create_new_keyset = True
-            elif replace_key_set:
-                key_id   = self.session.execute(key_insert_query, key_args).inserted_primary_key[0]
-                self.key_cache[key_name] = key_id
+            # As in AnnotatorUDF, only the first value of each key name is used
+            if key_name not in seen:
+                seen.add(key_name)
+                h, sign    = feature_hash(key_name, self.hash_bits)
+                values[h] += sign * value
+        for h, value in iteritems(values):
+            if value != 0:
+                yield Row(self.annotation_class, candidate_id=cid, key_id=int(self.hash_key_ids[h]), value=value)
 
-        # If AnnotationKey does not exist and create_new_keyset = False, skip
-        if key_id is not None:
 
-            # Updates the Annotation, assuming one might already exist, if try_update = True
-            if not clear:
-                res = self.session.execute(anno_update_query, {'cid': cid, 'kid': key_id, 'value': value})
+# Name of the AnnotationKey reserved for hash h in feature hashing mode
+HASH_KEY_NAME = 'HASH_%s'
+
+
+def feature_hash(key_name, hash_bits):
+    """
+    Returns the hash in [0, 2^hash_bits) and the sign (+1 or -1) of the annotation key key_name, for
+    signed feature hashing. The hash is stable across processes and runs, unlike Python's hash().
+    """
+    digest, = struct.unpack('<Q', md5(key_name.encode('utf-8')).digest()[:8])
+    return digest & ((1 << hash_bits) - 1), 1 if digest >> 63 else -1
+
 
-            # If Annotation does not exist, insert
-            if (clear or res.rowcount == 0) and value != 0:
-                self.session.execute(anno_insert_query, {'candidate_id': cid, 'key_id': key_id, 'value': value})
+def reserve_hash_keys(session, annotation_class, annotation_key_class, key_group, hash_bits):
+    """
+    Makes the AnnotationKeys of key_group exactly the 2^hash_bits keys HASH_0, HASH_1, ... of feature
+    hashing mode, inserting them in order (so that their matrix columns are in the order of their hashes)
+    and deleting any other keys of the group, with their Annotations
+    """
+    names    = [HASH_KEY_NAME % h for h in range(1 << hash_bits)]
+    existing = dict(session.query(annotation_key_class.name, annotation_key_class.id)
+                           .filter(annotation_key_class.group == key_group).all())
+    reserved = frozenset(names)
+    stale    = [kid for name, kid in iteritems(existing) if name not in reserved]
+    for batch in chunks(stale, PREFETCH_BATCH_SIZE):
+        session.query(annotation_class).filter(annotation_class.key_id.in_(batch))\
+               .delete(synchronize_session=False)
+        session.query(annotation_key_class).filter(annotation_key_class.id.in_(batch))\
+               .delete(synchronize_session=False)
+    missing = [{'name': name, 'group': key_group} for name in names if name not in existing]
+    if len(missing) > 0:
+        session.execute(annotation_key_class.__table__.insert(), missing)
+
+
+def load_hash_key_ids(session, annotation_key_class, key_group, hash_bits):
+    """Returns an array of the ids of the reserved AnnotationKeys of key_group, by hash"""
+    key_ids = np.zeros(1 << hash_bits, dtype=np.int64)
+    for name, kid in session.query(annotation_key_class.name, annotation_key_class.id)\
+                            .filter(annotation_key_class.group == key_group):
+        key_ids[int(name[len(HASH_KEY_NAME % ''):])] = kid
+    return key_ids
 
 
 def load_matrix(matrix_class, annotation_key_class, annotation_class, session,
     split=0, cids_query=None, key_group=0, key_names=None, zero_one=False,
-    load_as_array=False, coerce_int=True):
+    load_as_array=False, coerce_int=True, parallelism=None, cache_dir=None):
     """
     Returns the annotations corresponding to a split of candidates with N members
     and an AnnotationKey group with M distinct keys as an N x M CSR sparse matrix.
+
+    If parallelism > 1, the candidate id range is split into that many partitions, which are read by
+    separate processes; with Postgres, using COPY.
+
+    If cache_dir is set, the CSR arrays and the candidate and key ids are saved there, and later loads
+    of the same matrix reopen them memory-mapped (read-only) rather than querying the annotations. A
+    cached matrix is reused as long as the candidate and key ids and the count and checksums of the
+    selected annotations (over their candidate ids, key ids and values) are unchanged. One cache is kept
+    per annotation table, split, key group and candidate and key query. The arrays of a cached matrix are read-only, so it must be
+    copied before being modified in place.
     """
     cid_query = cids_query or session.query(Candidate.id)\
                                      .filter(Candidate.split == split)
-    cid_query = cid_query.order_by(Candidate.id)
 
     keys_query = session.query(annotation_key_class.id)
     keys_query = keys_query.filter(annotation_key_class.group == key_group)
     if key_names is not None:
         keys_query = keys_query.filter(annotation_key_class.name.in_(frozenset(key_names)))
-    keys_query = keys_query.order_by(annotation_key_class.id)
-
-    # First, we query to construct the row index map
-    cid_to_row = {}
-    row_to_cid = {}
-    for cid, in cid_query.all():
-        if cid not in cid_to_row:
-            j = len(cid_to_row)
-
-            # Create both mappings
-            cid_to_row[cid] = j
-            row_to_cid[j]   = cid
-
-    # Second, we query to construct the column index map
-    kid_to_col = {}
-    col_to_kid = {}
-    for kid, in keys_query.all():
-        if kid not in kid_to_col:
-            j = len(kid_to_col)
-
-            # Create both mappings
-            kid_to_col[kid] = j
-            col_to_kid[j]   = kid
-
-    # Create sparse matrix in COO format for incremental construction
-    row = []
-    columns = []
-    data = []
-
-    # Rely on the core for fast iteration
-    annot_select_query = annotation_class.__table__.select()
-
-    # Iteratively construct row index and output sparse matrix
-    # Cycles through the entire table to load the data.
-    # Perfornamce may slow down based on table size; however, negligible since
-    # it takes 8min to go throuh 245M rows (pretty fast).
-    for res in session.execute(annot_select_query):
-        # NOTE: The order of return seems to be switched in Python 3???
-        # Either way, make sure the order is set here explicitly!
-        cid, kid, val = res.candidate_id, res.key_id, res.value
-
-        if cid in cid_to_row and kid in kid_to_col:
-
-            # Optionally restricts val range to {0,1}, mapping -1 -> 0
-            if zero_one:
-                val = 1 if val == 1 else 0
-            row.append(cid_to_row[cid])
-            columns.append(kid_to_col[kid])
-            if coerce_int:
-                data.append(int(val))
-            else:
-                data.append(val)
 
-    X = sparse.coo_matrix((data, (row, columns)), shape=(len(cid_to_row), len(kid_to_col)))
+    # First, we query the sorted candidate and key ids; row / column i corresponds to the ith id
+    cids = np.unique(np.fromiter((cid for cid, in cid_query.order_by(Candidate.id)), dtype=np.int64))
+    kids = np.unique(np.fromiter((kid for kid, in keys_query.order_by(annotation_key_class.id)), dtype=np.int64))
+
+    # Second, we select only the annotations of these candidates and keys, by joining with their queries;
+    # cids_query may return an id more than once (e.g. if it joins the Candidates with their Labels)
+    table      = annotation_class.__table__
+    cid_sub    = cid_query.distinct().subquery()
+    kid_sub    = keys_query.distinct().subquery()
+    joined     = table.join(cid_sub, table.c.candidate_id == list(cid_sub.c)[0])\
+                      .join(kid_sub, table.c.key_id == list(kid_sub.c)[0])
+    annotations_query = select([table.c.candidate_id, table.c.key_id, table.c.value]).select_from(joined)
+
+    # Annotation values are loaded as ints if requested, or if they are ints in the database
+    dtype = np.int64 if coerce_int or zero_one or table.c.value.type.python_type is int else np.float64
+
+    # If a cached copy of this matrix is up to date, we reopen it rather than loading the annotations
+    if cache_dir is not None:
+        cache_path = _matrix_cache_path(session, cache_dir, table, joined, split, key_group, cids, kids,
+                                        dtype, zero_one, [cid_query, keys_query])
+        if os.path.isdir(cache_path):
+            X = _load_matrix_cache(cache_path, matrix_class, annotation_key_class)
+            return np.squeeze(X.toarray()) if load_as_array else X
+
+    if parallelism is not None and parallelism > 1 and len(cids) > 0:
+        cid_values, kid_values, data = _load_annotations_parallel(session, annotations_query,
+                                                                  table.c.candidate_id, cids, dtype, parallelism)
+    else:
+        n = session.execute(select([func.count()]).select_from(joined)).scalar()
+        cid_values, kid_values, data = _load_annotations(session, annotations_query, dtype, n)
+    row     = np.searchsorted(cids, cid_values)
+    columns = np.searchsorted(kids, kid_values)
+
+    # Optionally restricts val range to {0,1}, mapping -1 -> 0
+    if zero_one:
+        data = (data == 1).astype(np.int64)
+    X = sparse.coo_matrix((data, (row, columns)), shape=(len(cids), len(kids)))
+
+    if cache_dir is not None:
+        _save_matrix_cache(cache_path, X.tocsr(), cids, kids)
+        X = _load_matrix_cache(cache_path, matrix_class, annotation_key_class)
+        return np.squeeze(X.toarray()) if load_as_array else X
 
     # Return as an AnnotationMatrix
-    Xr = matrix_class(X, candidate_index=cid_to_row, row_index=row_to_cid,
-            annotation_key_cls=annotation_key_class, key_index=kid_to_col,
-            col_index=col_to_kid)
+    Xr = matrix_class(X, row_index=cids, annotation_key_cls=annotation_key_class, col_index=kids)
     return np.squeeze(Xr.toarray()) if load_as_array else Xr
 
 
+def _load_annotations(session, annotations_query, dtype, n=0):
+    """
+    Runs a query of (candidate id, key id, value) annotations, returning them as three arrays. The rows
+    are fetched in blocks into arrays preallocated for n rows, which grow if there are more.
+    """
+    cid_values = np.empty(n, dtype=np.int64)
+    kid_values = np.empty(n, dtype=np.int64)
+    data       = np.empty(n, dtype=dtype)
+
+    # With Postgres, streaming needs a transaction, so we use a new session rather than the AUTOCOMMIT one
+    stream_session = None
+    if snorkel_postgres:
+        stream_session = new_sessionmaker()()
+        stream_session.connection(execution_options={'isolation_level': 'READ COMMITTED'})
+        result = stream_session.execute(annotations_query.execution_options(stream_results=True))
+    else:
+        result = session.execute(annotations_query)
+    i = 0
+    try:
+        while True:
+            block = result.fetchmany(LOAD_MATRIX_FETCH_SIZE)
+            if len(block) == 0:
+                break
+            block = np.array([tuple(r) for r in block], dtype=np.float64 if dtype == np.float64 else np.int64)
+            if i + len(block) > len(data):
+                size       = max(i + len(block), 2 * len(data))
+                cid_values = np.resize(cid_values, size)
+                kid_values = np.resize(kid_values, size)
+                data       = np.resize(data, size)
+            cid_values[i:i + len(block)] = block[:, 0]
+            kid_values[i:i + len(block)] = block[:, 1]
+            data[i:i + len(block)]       = block[:, 2]
+            i += len(block)
+    finally:
+        result.close()
+        if stream_session is not None:
+            stream_session.close()
+    return cid_values[:i], kid_values[:i], data[:i]
+
+
+def _load_annotations_parallel(session, annotations_query, cid_column, cids, dtype, parallelism):
+    """
+    Runs a query of (candidate id, key id, value) annotations in parallel processes, each restricted to a
+    range of the sorted candidate ids cids, returning them as three arrays
+    """
+    # Each partition has about the same number of candidates; the query is sent with its parameters
+    # rendered, since Queries cannot be pickled
+    bounds = [cids[int(i * len(cids) / parallelism)] for i in range(parallelism)] + [cids[-1] + 1]
+    sqls   = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if lo < hi:
+            q = annotations_query.where(and_(cid_column >= int(lo), cid_column < int(hi)))
+            sqls.append(str(q.compile(dialect=session.bind.dialect, compile_kwargs={'literal_binds': True})))
+    pool = Pool(min(parallelism, len(sqls)))
+    try:
+        partitions = pool.map(_load_annotations_partition, [(sql, dtype) for sql in sqls])
+    finally:
+        pool.close()
+        pool.join()
+    return tuple(np.concatenate([p[j] for p in partitions]) for j in range(3))
+
+
+def _load_annotations_partition(args):
+    sql, dtype = args
+
+    # With Postgres, the rows are copied out as CSV to a temporary file, and parsed by pandas
+    if snorkel_postgres:
+        connection = get_engine().raw_connection()
+        try:
+            with TemporaryFile('w+') as f:
+                connection.cursor().copy_expert("COPY (%s) TO STDOUT WITH CSV" % sql, f)
+                f.seek(0)
+                df = read_csv(f, header=None, names=['candidate_id', 'key_id', 'value'],
+                              dtype={'candidate_id': np.int64, 'key_id': np.int64})
+        finally:
+            connection.close()
+        return df['candidate_id'].values, df['key_id'].values, df['value'].values.astype(dtype)
+
+    # Otherwise, we use a plain cursor
+    session = new_sessionmaker()()
+    try:
+        return _load_annotations(session, text(sql), dtype)
+    finally:
+        session.close()
+
+
+def _matrix_cache_path(session, cache_dir, table, joined, split, key_group, cids, kids, dtype, zero_one,
+                       queries):
+    """
+    Returns the directory in cache_dir for a matrix of the annotations in joined. Its name is a
+    fingerprint of the candidate and key ids and of the count and checksums of the annotations, so that it
+    changes when annotations are added, deleted, relabeled or moved to other candidates or keys. It is
+    prefixed by the split, key group and a hash of the candidate and key queries, so that the caches of
+    different subsets of candidates or keys are kept side by side.
+    """
+    # Each annotation is hashed, in SQL, by a non-linear function of its candidate id, key id and value
+    # modulo a prime, and the hashes are summed. Unlike plain sums of the columns (or of their products),
+    # the sums then change when the values are permuted among the same candidates and keys
+    P     = CHECKSUM_MODULUS
+    cid   = cast(table.c.candidate_id, BigInteger) % P
+    kid   = cast(table.c.key_id, BigInteger) % P
+    value = cast(func.round(cast(table.c.value, Float) * CHECKSUM_VALUE_SCALE), BigInteger) % P
+    value = (value + P) % P
+    sums  = []
+    for a_cid, a_kid, a_value, c, b in CHECKSUM_MULTIPLIERS:
+        x = (cid * a_cid % P + kid * a_kid % P + value * a_value % P + c) % P
+        y = x * x % P
+        sums.append(func.sum((y * y % P * b + x) % P))
+    n_sums = session.execute(select([func.count()] + sums).select_from(joined)).fetchone()
+    h = sha1()
+    h.update(cids.tobytes())
+    h.update(kids.tobytes())
+    h.update(repr(tuple(int(x or 0) for x in n_sums)).encode('utf-8'))
+
+    # Queries with the same SQL select the same candidates and keys
+    q = sha1()
+    for query in queries:
+        statement = query.statement
+        try:
+            sql = str(statement.compile(dialect=session.bind.dialect, compile_kwargs={'literal_binds': True}))
+        except Exception:
+            compiled = statement.compile(dialect=session.bind.dialect)
+            sql      = str(compiled) + repr(sorted(iteritems(compiled.params)))
+        q.update(sql.encode('utf-8'))
+    q.update(repr((np.dtype(dtype).str, bool(zero_one))).encode('utf-8'))
+    prefix = '%s_split%s_group%s_v%s_%s_' % (table.name, split, key_group, MATRIX_CACHE_VERSION,
+                                             q.hexdigest()[:10])
+    return os.path.join(cache_dir, prefix + h.hexdigest())
+
+
+def _save_matrix_cache(cache_path, X, cids, kids):
+    """
+    Saves the CSR matrix X with row and column ids cids and kids as raw .npy arrays in cache_path,
+    replacing any stale caches of the same split, key group and candidate and key queries
+    """
+    cache_dir, name = os.path.split(cache_path)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    prefix = name[:name.rindex('_') + 1]
+    for stale in os.listdir(cache_dir):
+        if stale.startswith(prefix) and stale != name:
+            shutil.rmtree(os.path.join(cache_dir, stale), ignore_errors=True)
+
+    # The arrays are written to a temporary directory which is then renamed, so that concurrent
+    # loads never see a partially written cache
+    tmp_path = mkdtemp(dir=cache_dir, prefix='.tmp_')
+    try:
+        for key, a in [('data', X.data), ('indices', X.indices), ('indptr', X.indptr),
+                       ('shape', np.array(X.shape, dtype=np.int64)), ('cids', cids), ('kids', kids)]:
+            np.save(os.path.join(tmp_path, key + '.npy'), a)
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # Another process already saved this cache
+        if not os.path.isdir(cache_path):
+            raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _load_matrix_cache(cache_path, matrix_class, annotation_key_class):
+    """Opens the matrix saved in cache_path, memory-mapping its arrays"""
+    arrays = dict((key, np.load(os.path.join(cache_path, key + '.npy'), mmap_mode='r'))
+                  for key in ['data', 'indices', 'indptr', 'shape', 'cids', 'kids'])
+    return matrix_class((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(arrays['shape']),
+            copy=False, row_index=arrays['cids'], annotation_key_cls=annotation_key_class, col_index=arrays['kids'])
+
+
 def load_label_matrix(session, **kwargs):
     return load_matrix(csr_LabelMatrix, LabelKey, Label, session, **kwargs)
 
@@ -419,6 +979,8 @@ class LabelAnnotator(Annotator):
     :param lfs: A _list_ of labeling functions (LFs)
     """
     def __init__(self, lfs=None, label_generator=None):
+        self.lfs             = lfs
+        self.label_generator = label_generator
         if lfs is not None:
             labels = lambda c : [(lf.__name__, lf(c)) for lf in lfs]
         elif label_generator is not None:
@@ -453,14 +1015,48 @@ class LabelAnnotator(Annotator):
 
         super(LabelAnnotator, self).__init__(Label, LabelKey, f_gen)
 
+    def get_config(self):
+        return self.lfs if self.lfs is not None else self.label_generator
+
     def load_matrix(self, session, **kwargs):
         return load_label_matrix(session, **kwargs)
 
 
 class FeatureAnnotator(Annotator):
-    """Apply feature generators to the candidates, generating Feature annotations"""
-    def __init__(self, f=get_span_feats):
-        super(FeatureAnnotator, self).__init__(Feature, FeatureKey, f)
+    """
+    Apply feature generators to the candidates, generating Feature annotations
+
+    :param hash_bits: If set, the features are mapped into a fixed set of 2^hash_bits FeatureKeys with
+        signed feature hashing, rather than having one FeatureKey each. The keys are reserved up front, so
+        there is no reduce step, the UDF processes write the Features directly, and every split of a key
+        group has a feature matrix with the same 2^hash_bits columns. A key group should only be used with
+        one value of hash_bits.
+    """
+    def __init__(self, f=get_span_feats, hash_bits=None):
+        self.hash_bits = hash_bits
+        if hash_bits is None:
+            super(FeatureAnnotator, self).__init__(Feature, FeatureKey, f)
+        else:
+            super(FeatureAnnotator, self).__init__(Feature, FeatureKey, f, udf_class=HashedAnnotatorUDF,
+                                                   hash_bits=hash_bits)
+
+    def apply(self, split=0, key_group=0, replace_key_set=True, cids_query=None, **kwargs):
+        if self.hash_bits is not None:
+            if not kwargs.get('clear', True):
+                raise ValueError("Feature hashing mode does not upsert Features, and so requires clear=True.")
+            session = new_sessionmaker()()
+            with write_scope(session):
+                reserve_hash_keys(session, Feature, FeatureKey, key_group, self.hash_bits)
+            session.close()
+        return super(FeatureAnnotator, self).apply(split=split, key_group=key_group,
+            replace_key_set=replace_key_set, cids_query=cids_query, **kwargs)
+
+    def clear(self, session, split=0, key_group=0, replace_key_set=True, cids_query=None, **kwargs):
+        # With feature hashing, the key set is fixed, so only the Features of the split are deleted
+        if self.hash_bits is not None:
+            replace_key_set = False
+        super(FeatureAnnotator, self).clear(session, split=split, key_group=key_group,
+            replace_key_set=replace_key_set, cids_query=cids_query, **kwargs)
 
     def load_matrix(self, session, **kwargs):
         return load_feature_matrix(session, coerce_int=False, **kwargs)
@@ -480,54 +1076,53 @@ def save_marginals(session, X, marginals, training=True):
     Note: The marginals for k=0 are not stored, only for k = 1,...,K
     """
     # Make sure that we are working with a numpy array
-    try:
-        shape = marginals.shape
-    except:
-        marginals = np.array(marginals)
-        shape = marginals.shape
+    marginals = np.asarray(marginals)
 
     # Handle binary input as M x 1-dim array; assume elements represent
-    # poksitive (k=1) class values
-    if len(shape) == 1:
+    # positive (k=1) class values
+    if marginals.ndim == 1:
         marginals = np.vstack([1-marginals, marginals]).T
 
     # Only add values for classes k=1,...,K
-    marginal_tuples = []
-    for i in range(shape[0]):
-        for k in range(1, shape[1] if len(shape) > 1 else 2):
-            if marginals[i, k] > 0:
-                marginal_tuples.append((i, k, marginals[i, k]))
-
-    # NOTE: This will delete all existing marginals of type `training`
-    session.query(Marginal).filter(Marginal.training == training).\
-        delete(synchronize_session='fetch')
-
-    # Prepare bulk INSERT query
-    q = Marginal.__table__.insert()
+    rows, ks = np.nonzero(marginals[:, 1:] > 0)
+    ks      += 1
+    probs    = marginals[rows, ks].astype(np.float64)
 
     # Check whether X is an AnnotationMatrix or not
-    anno_matrix = isinstance(X, csr_AnnotationMatrix)
-    if not anno_matrix:
-        X = list(X)
-
-    # Prepare values
-    insert_vals = []
-    for i, k, p in marginal_tuples:
-        cid = X.get_candidate(session, i).id if anno_matrix else X[i].id
-        insert_vals.append({
-            'candidate_id': cid,
-            'training': training,
-            'value': k,
-            # We cast p in case its a numpy type, which psycopg2 does not handle
-            'probability': float(p)
-        })
-
-    # Execute update
-    session.execute(q, insert_vals)
-    session.commit()
+    if isinstance(X, csr_AnnotationMatrix):
+        cids = X.get_candidate_ids()
+    else:
+        cids = np.array([x.id for x in X], dtype=np.int64)
+
+    # Replace the marginals of these candidates in one transaction
+    # NOTE: This deletes the existing marginals of type `training` of the candidates in X only
+    table = Marginal.__table__
+    with write_scope(session):
+        for batch in chunks(cids.tolist(), PREFETCH_BATCH_SIZE):
+            session.execute(table.delete().where(and_(table.c.training == training,
+                                                      table.c.candidate_id.in_(batch))))
+        if snorkel_postgres:
+            _copy_marginals(session, cids[rows], ks, probs, training)
+        else:
+            for batch in chunks(zip(cids[rows].tolist(), ks.tolist(), probs.tolist()), MARGINALS_BATCH_SIZE):
+                session.execute(table.insert(), [
+                    {'candidate_id': cid, 'training': training, 'value': k, 'probability': p}
+                    for cid, k, p in batch
+                ])
     print("Saved %s marginals" % len(marginals))
 
 
+def _copy_marginals(session, cids, ks, probs, training):
+    """Writes marginals to Postgres with COPY, in the transaction of session"""
+    with TemporaryFile('w+') as f:
+        DataFrame({'candidate_id': cids, 'training': training, 'value': ks, 'probability': probs})\
+            .to_csv(f, header=False, index=False, columns=['candidate_id', 'training', 'value', 'probability'])
+        f.seek(0)
+        cursor = session.connection().connection.cursor()
+        cursor.copy_expert("COPY %s (candidate_id, training, value, probability) FROM STDIN WITH CSV" %
+                           Marginal.__tablename__, f)
+
+
 def load_marginals(session, X=None, split=0, cids_query=None, training=True):
     """Load the marginal probs. for a given split of Candidates"""
     # For candidate ids subquery
@@ -537,12 +1132,16 @@ def load_marginals(session, X=None, split=0, cids_query=None, training=True):
     cids_query = cids_query.order_by(Candidate.id)
     cids_sub_query = cids_query.subquery('cids')
 
-    # Load marginal tuples from db
+    # Load marginal tuples from db, as arrays of candidate ids, values and probabilities
     marginal_tuples = session.query(Marginal.candidate_id, Marginal.value,
         Marginal.probability) \
         .filter(Marginal.candidate_id == cids_sub_query.c.id) \
         .filter(Marginal.training == training) \
         .all()
+    marginal_tuples = np.array([tuple(t) for t in marginal_tuples], dtype=np.float64).reshape(-1, 3)
+    cids  = marginal_tuples[:, 0].astype(np.int64)
+    ks    = marginal_tuples[:, 1].astype(np.int64)
+    probs = marginal_tuples[:, 2]
 
     # If an AnnotationMatrix or list of candidates X is provided, we make sure
     # that the returned marginals are collated with X.
@@ -558,25 +1157,25 @@ def load_marginals(session, X=None, split=0, cids_query=None, training=True):
         except:
             cardinality = X[0].cardinality
             marginals = np.zeros((len(X), cardinality))
-            cid_map = dict([(x.id, i) for i, x in enumerate(X)])
+            cid_map = InverseIdIndex([x.id for x in X])
 
     # Otherwise if X is not provided, we sort by candidate id, using the
     # cids_query from above
     else:
         cardinality = session.query(Candidate) \
-            .get(marginal_tuples[0][0]).cardinality
-        marginals = np.zeros((cids_query.count(), cardinality))
-        cid_map = dict([(cid, i) for i, (cid,) in enumerate(cids_query.all())])
+            .get(int(cids[0])).cardinality
+        cid_map = InverseIdIndex([cid for cid, in cids_query.all()])
+        marginals = np.zeros((len(cid_map), cardinality))
 
-    # Assemble the marginals matrix according to the candidate index of X
-    for cid, k, p in marginal_tuples:
-        marginals[cid_map[cid], k] = p
+    # Assemble the marginals matrix according to the candidate index of X,
+    # skipping any candidates which are not in X
+    rows = cid_map.lookup(cids)
+    keep = rows >= 0
+    marginals[rows[keep], ks[keep]] = probs[keep]
 
     # Add first column if k > 2, else ravel
     if cardinality > 2:
-        row_sums = marginals.sum(axis=1)
-        for i in range(marginals.shape[0]):
-            marginals[i, 0] = 1 - row_sums[i]
+        marginals[:, 0] = 1 - marginals.sum(axis=1)
     else:
         marginals = np.ravel(marginals[:, 1])
     return marginals
@@ -11,11 +11,96 @@ from itertools import product
 import re
 from sqlalchemy.sql import select
 
-from snorkel.models import Candidate, TemporarySpan, Sentence
-from snorkel.udf import UDF, UDFRunner
+from snorkel.models import Candidate, Context, TemporarySpan, Sentence, Span
+from snorkel.udf import Row, UDF, UDFRunner, chunks, config_hash
 
 QUEUE_COLLECT_TIMEOUT = 5
 
+# Maximum number of ids per IN clause when prefetching, within the limit on query parameters of SQLite
+PREFETCH_BATCH_SIZE = 500
+
+
+def load_span_ids(session, sentence_ids):
+    """Returns a dict of the ids of the existing Spans of the Sentences with ids sentence_ids, by stable id"""
+    span_ids = {}
+    for batch in chunks(sentence_ids, PREFETCH_BATCH_SIZE):
+        q = select([Context.id, Context.stable_id])\
+            .select_from(Span.__table__.join(Context.__table__, Span.id == Context.id))\
+            .where(Span.sentence_id.in_(batch))
+        for context_id, stable_id in session.execute(q):
+            span_ids[stable_id] = context_id
+    return span_ids
+
+
+class SpanIdCache(object):
+    """
+    Resolves the ids of the existing Contexts of TemporarySpans, with the ids of all the existing Spans
+    of a chunk of Sentences loaded up front rather than one query per TemporarySpan
+    """
+    def __init__(self):
+        self.sentence_ids = frozenset()
+        self.span_ids     = {}
+
+    def prefetch(self, session, contexts):
+        self.sentence_ids = frozenset(c.id for c in contexts if isinstance(c, Sentence))
+        self.span_ids     = load_span_ids(session, sorted(self.sentence_ids))
+
+    def load_id(self, session, tc):
+        """Loads and returns the id of the Context of TemporaryContext tc, if it exists (else None)"""
+        sentence = getattr(tc, 'sentence', None)
+        if tc.id is None and sentence is not None and sentence.id in self.sentence_ids:
+            tc.id = self.span_ids.get(tc.get_stable_id())
+            return tc.id
+        return tc.load_id(session)
+
+
+def load_candidate_args(session, candidate_class, sentence_ids):
+    """
+    Returns the set of the argument id tuples of the existing Candidates of candidate_class, the first
+    argument of which is a Span of the Sentences with ids sentence_ids
+    """
+    arg_ids = [getattr(candidate_class, arg_name + '_id') for arg_name in candidate_class.__argnames__]
+    args    = set()
+    for batch in chunks(sentence_ids, PREFETCH_BATCH_SIZE):
+        q = select(arg_ids)\
+            .select_from(candidate_class.__table__.join(Span.__table__, arg_ids[0] == Span.id))\
+            .where(Span.sentence_id.in_(batch))
+        args.update(tuple(row) for row in session.execute(q))
+    return args
+
+
+class CandidateArgsCache(object):
+    """
+    Checks for existing Candidates by their argument ids (the unique constraint of candidate_class), with
+    the argument ids of all the existing Candidates of a chunk of Sentences loaded with one query, when
+    first needed, rather than one query per Candidate
+    """
+    def __init__(self, candidate_class):
+        self.candidate_class = candidate_class
+        self.sentence_ids    = frozenset()
+        self.args            = None
+
+    def prefetch(self, contexts):
+        self.sentence_ids = frozenset(c.id for c in contexts if isinstance(c, Sentence))
+        self.args         = None
+
+    def exists(self, session, context, arg_ids):
+        """
+        Whether a Candidate with the tuple of argument ids arg_ids exists; if not, it is assumed to be
+        written, so that it is not extracted twice from the chunk
+        """
+        if context.id not in self.sentence_ids:
+            q = select([self.candidate_class.id])
+            for arg_name, arg_id in zip(self.candidate_class.__argnames__, arg_ids):
+                q = q.where(getattr(self.candidate_class, arg_name + '_id') == arg_id)
+            return session.execute(q).first() is not None
+        if self.args is None:
+            self.args = load_candidate_args(session, self.candidate_class, sorted(self.sentence_ids))
+        if arg_ids in self.args:
+            return True
+        self.args.add(arg_ids)
+        return False
+
 
 class CandidateExtractor(UDFRunner):
     """
@@ -46,6 +131,10 @@ class CandidateExtractor(UDFRunner):
     def apply(self, xs, split=0, **kwargs):
         super(CandidateExtractor, self).apply(xs, split=split, **kwargs)
 
+    def get_run_name(self, split=0, **kwargs):
+        return "%s(%s, split=%s)[%s]" % (self.__class__.__name__, self.udf_init_kwargs['candidate_class'].__name__,
+                                         split, config_hash(self.get_config()))
+
     def clear(self, session, split, **kwargs):
         session.query(Candidate).filter(Candidate.split == split).delete()
 
@@ -74,15 +163,32 @@ class CandidateExtractorUDF(UDF):
         for i in range(self.arity):
             self.child_context_sets[i] = set()
 
+        # The ids of the existing Spans and Candidates of the current chunk of contexts, see prefetch
+        self.span_id_cache        = SpanIdCache()
+        self.candidate_args_cache = CandidateArgsCache(candidate_class)
+
         super(CandidateExtractorUDF, self).__init__(**kwargs)
 
+    @staticmethod
+    def get_item_id(context):
+        return context.stable_id
+
+    def prefetch(self, contexts):
+        """Loads the ids of the existing Spans of a chunk of Sentences, with one query per PREFETCH_BATCH_SIZE"""
+        self.span_id_cache.prefetch(self.session, contexts)
+        self.candidate_args_cache.prefetch(contexts)
+
     def apply(self, context, clear, split, **kwargs):
         # Generate TemporaryContexts that are children of the context using the candidate_space and filtered
-        # by the Matcher
+        # by the Matcher. Contexts which are not in the database yet are yielded as Rows, which the
+        # Candidates then reference
+        new_contexts = {}
         for i in range(self.arity):
             self.child_context_sets[i].clear()
             for tc in self.matchers[i].apply(self.candidate_spaces[i].apply(context)):
-                tc.load_id_or_insert(self.session)
+                if self.span_id_cache.load_id(self.session, tc) is None and tc not in new_contexts:
+                    new_contexts[tc] = Row(tc.get_context_class(), **tc.get_insert_values())
+                    yield new_contexts[tc]
                 self.child_context_sets[i].add(tc)
 
         # Generates and persists candidates
@@ -111,19 +217,17 @@ class CandidateExtractorUDF(UDF):
 
             # Assemble candidate arguments
             for i, arg_name in enumerate(self.candidate_class.__argnames__):
-                candidate_args[arg_name + '_id'] = args[i][1].id
-
-            # Checking for existence
-            if not clear:
-                q = select([self.candidate_class.id])
-                for key, value in iteritems(candidate_args):
-                    q = q.where(getattr(self.candidate_class, key) == value)
-                candidate_id = self.session.execute(q).first()
-                if candidate_id is not None:
+                tc = args[i][1]
+                candidate_args[arg_name + '_id'] = tc.id if tc.id is not None else new_contexts[tc]
+
+            # Checking for existence (only possible if all of the arguments exist already)
+            if not clear and not any(isinstance(v, Row) for v in candidate_args.values()):
+                arg_ids = tuple(candidate_args[arg_name + '_id'] for arg_name in self.candidate_class.__argnames__)
+                if self.candidate_args_cache.exists(self.session, context, arg_ids):
                     continue
 
-            # Add Candidate to session
-            yield self.candidate_class(**candidate_args)
+            # Yield Candidate to be written
+            yield Row(self.candidate_class, **candidate_args)
 
 
 class CandidateSpace(object):
@@ -195,6 +299,10 @@ class PretaggedCandidateExtractor(UDFRunner):
     def apply(self, xs, split=0, **kwargs):
         super(PretaggedCandidateExtractor, self).apply(xs, split=split, **kwargs)
 
+    def get_run_name(self, split=0, **kwargs):
+        return "%s(%s, split=%s)[%s]" % (self.__class__.__name__, self.udf_init_kwargs['candidate_class'].__name__,
+                                         split, config_hash(self.get_config()))
+
     def clear(self, session, split, **kwargs):
         session.query(Candidate).filter(Candidate.split == split).delete()
 
@@ -213,8 +321,21 @@ class PretaggedCandidateExtractorUDF(UDF):
         self.symmetric_relations = symmetric_relations
         self.entity_sep          = entity_sep
 
+        # The ids of the existing Spans and Candidates of the current chunk of contexts, see prefetch
+        self.span_id_cache        = SpanIdCache()
+        self.candidate_args_cache = CandidateArgsCache(candidate_class)
+
         super(PretaggedCandidateExtractorUDF, self).__init__(**kwargs)
 
+    @staticmethod
+    def get_item_id(context):
+        return context.stable_id
+
+    def prefetch(self, contexts):
+        """Loads the ids of the existing Spans of a chunk of Sentences, with one query per PREFETCH_BATCH_SIZE"""
+        self.span_id_cache.prefetch(self.session, contexts)
+        self.candidate_args_cache.prefetch(contexts)
+
     def apply(self, context, clear, split, check_for_existing=True, **kwargs):
         """Extract Candidates from a Context"""
         # For now, just handle Sentences
@@ -232,9 +353,10 @@ class PretaggedCandidateExtractorUDF(UDF):
                     if et in entity_idxs:
                         entity_idxs[et][cid].append(i)
 
-        # Form entity Spans
+        # Form entity Spans; those which are not in the database yet are yielded as Rows
         entity_spans = defaultdict(list)
         entity_cids  = {}
+        new_contexts = {}
         for et, cid_idxs in iteritems(entity_idxs):
             for cid, idxs in iteritems(entity_idxs[et]):
                 while len(idxs) > 0:
@@ -245,10 +367,12 @@ class PretaggedCandidateExtractorUDF(UDF):
                         i        = idxs.pop(0)
                         char_end = context.char_offsets[i] + len(context.words[i]) - 1
 
-                    # Insert / load temporary span, also store map to entity CID
+                    # Load temporary span, also store map to entity CID
                     tc = TemporarySpan(char_start=char_start, char_end=char_end, sentence=context)
-                    tc.load_id_or_insert(self.session)
-                    entity_cids[tc.id] = cid
+                    if self.span_id_cache.load_id(self.session, tc) is None and tc not in new_contexts:
+                        new_contexts[tc] = Row(tc.get_context_class(), **tc.get_insert_values())
+                        yield new_contexts[tc]
+                    entity_cids[tc] = cid
                     entity_spans[et].append(tc)
 
         # Generates and persists candidates
@@ -271,17 +395,15 @@ class PretaggedCandidateExtractorUDF(UDF):
 
             # Assemble candidate arguments
             for i, arg_name in enumerate(self.candidate_class.__argnames__):
-                candidate_args[arg_name + '_id'] = args[i][1].id
-                candidate_args[arg_name + '_cid'] = entity_cids[args[i][1].id]
-
-            # Checking for existence
-            if check_for_existing:
-                q = select([self.candidate_class.id])
-                for key, value in iteritems(candidate_args):
-                    q = q.where(getattr(self.candidate_class, key) == value)
-                candidate_id = self.session.execute(q).first()
-                if candidate_id is not None:
+                tc = args[i][1]
+                candidate_args[arg_name + '_id'] = tc.id if tc.id is not None else new_contexts[tc]
+                candidate_args[arg_name + '_cid'] = entity_cids[tc]
+
+            # Checking for existence (only possible if all of the arguments exist already)
+            if check_for_existing and not any(isinstance(v, Row) for v in candidate_args.values()):
+                arg_ids = tuple(candidate_args[arg_name + '_id'] for arg_name in self.candidate_class.__argnames__)
+                if self.candidate_args_cache.exists(self.session, context, arg_ids):
                     continue
 
-            # Add Candidate to session
-            yield self.candidate_class(**candidate_args)
+            # Yield Candidate to be written
+            yield Row(self.candidate_class, **candidate_args)
@@ -6,7 +6,53 @@ from builtins import *
 
 from collections import defaultdict
 from functools import partial
-from snorkel.models import Span
+from sqlalchemy.orm import object_session
+from snorkel.models import Document, Sentence, Span
+from snorkel.utils import context_cache
+
+
+# Number of contexts whose n-gram counts are kept by get_context_token_counts
+TOKEN_COUNT_CACHE_SIZE = 100
+
+_token_count_cache = context_cache(TOKEN_COUNT_CACHE_SIZE)
+
+
+def get_document_tokens(document, attr):
+    """
+    Returns the @attr token lists of the sentences of @document, in order, loading only that
+    column of all its sentences with one query
+    """
+    session = object_session(document)
+    if session is None:
+        return [getattr(sent, attr) for sent in document.get_sentence_generator()]
+    column = getattr(Sentence, attr)
+    q = session.query(column).filter(Sentence.document_id == document.id).order_by(Sentence.position)
+    return [tokens for tokens, in q]
+
+
+def get_context_token_counts(context, attr, ngram):
+    """
+    Returns a dict of the counts of the n-grams of length up to @ngram of the @attr tokens of the
+    sentences of @context, caching those of the last TOKEN_COUNT_CACHE_SIZE contexts so that the
+    candidates of a context share one count. The counts must not be modified. The cache is cleared at
+    the start of each UDF run, see clear_context_caches.
+    """
+    key    = (context.__class__.__name__, context.id, context.stable_id, attr, ngram)
+    counts = _token_count_cache.get(key)
+    if counts is None:
+        if isinstance(context, Document):
+            sentence_tokens = get_document_tokens(context, attr)
+        else:
+            sentence_tokens = [getattr(sent, attr) for sent in context.get_sentence_generator()]
+        counts = defaultdict(int)
+        for tokens in sentence_tokens:
+            tokens = tokens or []
+            for i in range(len(tokens)):
+                for j in range(i+1, min(len(tokens), i + ngram) + 1):
+                    counts[' '.join(tokens[i:j])] += 1
+        counts = dict(counts)
+        _token_count_cache[key] = counts
+    return counts
 
 
 def get_token_count_feats(candidate, context, attr, ngram, stopwords):
@@ -21,12 +67,7 @@ def get_token_count_feats(candidate, context, attr, ngram, stopwords):
     if not isinstance(args[0], Span):
         raise ValueError("Accepts Span-type arguments, %s-type found.")
 
-    counter = defaultdict(int)
-    # Count n-gram instances
-    for tokens in (sent[attr] for sent in context.get_sentence_generator()):
-        for i in range(len(tokens)):
-            for j in range(i+1, min(len(tokens), i + ngram) + 1):
-                counter[' '.join(tokens[i:j])] += 1
+    counter = get_context_token_counts(context, attr, ngram)
     # Yield counts if n-gram is not in stopwords
     for gram in counter:
         if (not stopwords) or not all([t in stopwords for t in gram.split()]):
@@ -41,7 +82,7 @@ def get_document_token_count_feats_base(candidate, attr, ngram, stopwords):
 
 def get_sentence_token_count_feats_base(candidate, attr, ngram, stopwords):
     """Apply @get_token_count_feats over the parent @Sentence of @candidate"""
-    sentence = candidate.get_parent().get_parent()
+    sentence = candidate.get_parent()
     return get_token_count_feats(candidate, sentence, attr, ngram, stopwords)
 
 
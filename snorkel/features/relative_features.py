@@ -13,10 +13,64 @@ from treedlib import compile_relation_feature_generator
 
 from snorkel.features.entity_features import compile_entity_feature_generator, get_ddlib_feats
 from snorkel.models import Span
-from snorkel.utils import get_as_dict
+from snorkel.utils import context_cache, get_as_dict
 from snorkel.vis.tree_structs import corenlp_to_xmltree
 
 
+# Number of Sentences whose dicts and XML trees are kept by get_sentence_dict and get_sentence_xmltree
+XMLTREE_CACHE_SIZE = 1000
+
+# The TreeDLib feature generators, compiled once per process, and the cached sentence dicts and XML trees
+_entity_feature_generator   = None
+_relation_feature_generator = None
+_sentence_dict_cache        = context_cache(XMLTREE_CACHE_SIZE)
+_xmltree_cache              = context_cache(XMLTREE_CACHE_SIZE)
+
+
+def get_entity_feature_generator():
+    """Returns the TreeDLib entity feature generator, compiling it on first use"""
+    global _entity_feature_generator
+    if _entity_feature_generator is None:
+        _entity_feature_generator = compile_entity_feature_generator()
+    return _entity_feature_generator
+
+
+def get_relation_feature_generator():
+    """Returns the TreeDLib relation feature generator, compiling it on first use"""
+    global _relation_feature_generator
+    if _relation_feature_generator is None:
+        _relation_feature_generator = compile_relation_feature_generator()
+    return _relation_feature_generator
+
+
+def get_sentence_dict(sentence):
+    """
+    Returns get_as_dict(@sentence), caching the dicts of the last XMLTREE_CACHE_SIZE Sentences by id so
+    that the candidates of a sentence share one dict. The dicts must not be modified. The cache is
+    cleared at the start of each UDF run, see clear_context_caches.
+    """
+    key       = (sentence.id, sentence.stable_id)
+    sent_dict = _sentence_dict_cache.get(key)
+    if sent_dict is None:
+        sent_dict = get_as_dict(sentence)
+        _sentence_dict_cache[key] = sent_dict
+    return sent_dict
+
+
+def get_sentence_xmltree(sentence):
+    """
+    Returns the XML tree of @sentence, caching the trees of the last XMLTREE_CACHE_SIZE Sentences by id
+    so that the candidates of a sentence share one tree. The trees must not be modified. The cache is
+    cleared at the start of each UDF run, see clear_context_caches.
+    """
+    key     = (sentence.id, sentence.stable_id)
+    xmltree = _xmltree_cache.get(key)
+    if xmltree is None:
+        xmltree = corenlp_to_xmltree(get_sentence_dict(sentence))
+        _xmltree_cache[key] = xmltree
+    return xmltree
+
+
 def get_span_splits(candidate, stopwords=None):
     """Base function for candidate span tokens split on whitespace
     and punctuation
@@ -37,9 +91,9 @@ def get_span_splits_stopwords(stopwords):
 
 def get_unary_span_feats(sidxs, sentence, stopwords):
     """Get unary span features from DDLib and TreeDLib"""
-    get_tdl_feats = compile_entity_feature_generator()
-    sent_dict     = get_as_dict(sentence)
-    xmltree       = corenlp_to_xmltree(sent_dict)
+    get_tdl_feats = get_entity_feature_generator()
+    sent_dict     = get_sentence_dict(sentence)
+    xmltree       = get_sentence_xmltree(sentence)
     if len(sidxs) > 0:
         # Add DDLIB entity features
         for f in get_ddlib_feats(sent_dict, sidxs):
@@ -51,8 +105,8 @@ def get_unary_span_feats(sidxs, sentence, stopwords):
 
 def get_binary_span_feats(sidxs, sentence, stopwords):
     """Get binary (relation) span features from TreeDLib"""
-    get_tdl_feats = compile_relation_feature_generator()
-    xmltree = corenlp_to_xmltree(get_as_dict(sentence))
+    get_tdl_feats = get_relation_feature_generator()
+    xmltree = get_sentence_xmltree(sentence)
     s1_idxs, s2_idxs = sidxs
     if len(s1_idxs) > 0 and len(s2_idxs) > 0:
         # Apply TDL features
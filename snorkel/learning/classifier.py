@@ -112,9 +112,8 @@ class Classifier(object):
         test_marginals = self.marginals(X_test, **kwargs)
 
         # Get the test candidates
-        test_candidates = [
-            X_test.get_candidate(session, i) for i in range(X_test.shape[0])
-        ] if not self.representation else X_test
+        test_candidates = X_test.get_candidates(session) \
+            if not self.representation else X_test
 
         # Initialize and return scorer
         s = scorer(test_candidates, Y_test, gold_candidate_set)          
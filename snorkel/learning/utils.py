@@ -17,6 +17,8 @@ from queue import Empty
 
 from pandas import DataFrame
 
+from snorkel.utils import LF_STATS_BLOCK_SIZE, label_matrix_stats
+
 
 ############################################################
 ### General Learning Utilities
@@ -623,7 +625,7 @@ def candidate_coverage(L):
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
     Return the **fraction of candidates which have > 0 (non-zero) labels.**
     """
-    return np.where(sparse_abs(L).sum(axis=1) != 0, 1, 0).sum() / float(L.shape[0])
+    return label_matrix_stats(L)['candidate_coverage'] / float(L.shape[0])
 
 
 def LF_coverage(L):
@@ -631,7 +633,7 @@ def LF_coverage(L):
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
     Return the **fraction of candidates that each LF labels.**
     """
-    return np.ravel(sparse_abs(L).sum(axis=0) / float(L.shape[0]))
+    return label_matrix_stats(L)['coverage'] / float(L.shape[0])
 
 
 def candidate_overlap(L):
@@ -639,7 +641,7 @@ def candidate_overlap(L):
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
     Return the **fraction of candidates which have > 1 (non-zero) labels.**
     """
-    return np.where(sparse_abs(L).sum(axis=1) > 1, 1, 0).sum() / float(L.shape[0])
+    return label_matrix_stats(L)['candidate_overlap'] / float(L.shape[0])
 
 
 def LF_overlaps(L):
@@ -647,8 +649,7 @@ def LF_overlaps(L):
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
     Return the **fraction of candidates that each LF _overlaps with other LFs on_.**
     """
-    L_abs = sparse_abs(L)
-    return np.ravel(np.where(L_abs.sum(axis=1) > 1, 1, 0).T * L_abs / float(L.shape[0]))
+    return label_matrix_stats(L)['overlaps'] / float(L.shape[0])
 
 
 def candidate_conflict(L):
@@ -656,7 +657,7 @@ def candidate_conflict(L):
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
     Return the **fraction of candidates which have > 1 (non-zero) labels _which are not equal_.**
     """
-    return np.where(sparse_abs(L).sum(axis=1) != sparse_abs(L.sum(axis=1)), 1, 0).sum() / float(L.shape[0])
+    return label_matrix_stats(L)['candidate_conflict'] / float(L.shape[0])
 
 
 def LF_conflicts(L):
@@ -664,8 +665,7 @@ def LF_conflicts(L):
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
     Return the **fraction of candidates that each LF _conflicts with other LFs on_.**
     """
-    L_abs = sparse_abs(L)
-    return np.ravel(np.where(L_abs.sum(axis=1) != sparse_abs(L.sum(axis=1)), 1, 0).T * L_abs / float(L.shape[0]))
+    return label_matrix_stats(L)['conflicts'] / float(L.shape[0])
 
 
 def LF_accuracies(L, labels):
@@ -673,7 +673,48 @@ def LF_accuracies(L, labels):
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate, and labels {-1,1}
     Return the accuracy of each LF w.r.t. these labels
     """
-    return np.ravel(0.5*(L.T.dot(labels) / sparse_abs(L).sum(axis=0) + 1))
+    stats = label_matrix_stats(L, labels)
+    return 0.5*((stats['tp'] + stats['tn'] - stats['fp'] - stats['fn']) / stats['coverage'] + 1)
+
+
+def LF_pairwise_stats(L, normalize=False, block_size=LF_STATS_BLOCK_SIZE):
+    """
+    Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
+    Return three sparse M x M matrices of the **number of candidates that each pair of LFs both label
+    (co-coverage), give the same label (agreements) and give different labels (disagreements).**
+    If normalize is True, these are fractions of the N candidates instead.
+
+    These are computed with sparse products of the indicator matrices of each label value (e.g. one
+    for -1 and one for 1), over blocks of block_size rows to bound the memory used.
+    """
+    L = sparse.csr_matrix(L)
+    if not L.has_canonical_format:
+        L = L.copy()
+        L.sum_duplicates()
+    M = L.shape[1]
+    values        = np.unique(L.data[L.data != 0])
+    co_coverage   = sparse.csr_matrix((M, M), dtype=np.int64)
+    agreements    = sparse.csr_matrix((M, M), dtype=np.int64)
+    for start in range(0, L.shape[0], block_size):
+        B  = L[start:start + block_size]
+        nz = _indicator_matrix(B, B.data != 0)
+        co_coverage = co_coverage + nz.T.dot(nz)
+        for value in values:
+            I = _indicator_matrix(B, B.data == value)
+            agreements = agreements + I.T.dot(I)
+    disagreements = co_coverage - agreements
+    disagreements.eliminate_zeros()
+    if normalize:
+        N = float(L.shape[0])
+        return co_coverage / N, agreements / N, disagreements / N
+    return co_coverage, agreements, disagreements
+
+
+def _indicator_matrix(B, mask):
+    """Returns the sparse 0/1 matrix of the entries of the CSR matrix B selected by mask"""
+    I = sparse.csr_matrix((mask.astype(np.int64), B.indices, B.indptr), shape=B.shape, copy=True)
+    I.eliminate_zeros()
+    return I
 
 
 def training_set_summary_stats(L, return_vals=True, verbose=False):
@@ -682,7 +723,9 @@ def training_set_summary_stats(L, return_vals=True, verbose=False):
     Return simple summary statistics
     """
     N, M = L.shape
-    coverage, overlap, conflict = candidate_coverage(L), candidate_overlap(L), candidate_conflict(L)
+    stats = label_matrix_stats(L)
+    coverage, overlap, conflict = [stats[key] / float(N) for key in
+        ['candidate_coverage', 'candidate_overlap', 'candidate_conflict']]
     if verbose:
         print("=" * 60)
         print("LF Summary Statistics: %s LFs applied to %s candidates" % (M, N))
@@ -147,19 +147,32 @@ class TemporaryContext(object):
     def __init__(self):
         self.id = None
 
-    def load_id_or_insert(self, session):
+    def load_id(self, session):
+        """Loads the id of the corresponding Context if it exists, and returns it (else None)"""
         if self.id is None:
-            stable_id = self.get_stable_id()
-            id = session.execute(select([Context.id]).where(Context.stable_id == stable_id)).first()
-            if id is None:
-                self.id = session.execute(
-                        Context.__table__.insert(),
-                        {'type': self._get_table_name(), 'stable_id': stable_id}).inserted_primary_key[0]
-                insert_args = self._get_insert_args()
-                insert_args['id'] = self.id
-                session.execute(text(self._get_insert_query()), insert_args)
-            else:
+            id = session.execute(select([Context.id]).where(Context.stable_id == self.get_stable_id())).first()
+            if id is not None:
                 self.id = id[0]
+        return self.id
+
+    def load_id_or_insert(self, session):
+        if self.load_id(session) is None:
+            self.id = session.execute(
+                    Context.__table__.insert(),
+                    {'type': self._get_table_name(), 'stable_id': self.get_stable_id()}).inserted_primary_key[0]
+            insert_args = self._get_insert_args()
+            insert_args['id'] = self.id
+            session.execute(text(self._get_insert_query()), insert_args)
+
+    def get_context_class(self):
+        """Returns the Context subclass corresponding to this TemporaryContext"""
+        return Context.__mapper__.polymorphic_map[self._get_polymorphic_identity()].class_
+
+    def get_insert_values(self):
+        """Returns the column values of the corresponding Context, for inserting it in bulk"""
+        values = self._get_insert_args()
+        values['stable_id'] = self.get_stable_id()
+        return values
 
     def __eq__(self, other):
         raise NotImplementedError()
@@ -4,10 +4,12 @@ from __future__ import print_function
 from builtins import *
 
 import os
-from sqlalchemy import create_engine, event
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import Pool
 
 # Sets connection string
 snorkel_conn_string = os.environ['SNORKELDB'] if 'SNORKELDB' in os.environ and os.environ['SNORKELDB'] != '' \
@@ -18,29 +20,106 @@ snorkel_conn_string = os.environ['SNORKELDB'] if 'SNORKELDB' in os.environ and o
 snorkel_postgres = snorkel_conn_string.startswith('postgres')
 
 
-# Automatically turns on foreign key enforcement for SQLite
+# Automatically turns on foreign key enforcement for SQLite, and write-ahead logging, so that readers
+# (e.g. UDF processes) do not block the writer
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
     if snorkel_conn_string.startswith('sqlite'):
         cursor = dbapi_connection.cursor()
         cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.execute("PRAGMA journal_mode=WAL")
         cursor.close()
 
 
-# Defines procedure for setting up a sessionmaker
+# Keyword arguments for create_engine, e.g. pool_size and max_overflow with Postgres; see configure_engine
+engine_kwargs = {}
+
+# Maps process id -> the Engine of that process, see get_engine
+_engines = {}
+
+
+def get_engine():
+    """
+    Returns the Engine of the current process, creating it if needed. A process forked from one with
+    an Engine gets its own on first use, rather than sharing the pooled connections of its parent.
+    """
+    pid = os.getpid()
+    if pid not in _engines:
+
+        # Turning on autocommit for Postgres, see http://oddbird.net/2014/06/14/sqlalchemy-postgres-autocommit/
+        # Otherwise any e.g. query starts a transaction, locking tables... very bad for e.g. multiple notebooks
+        # open, multiple processes, etc.
+        if snorkel_postgres:
+            engine = create_engine(snorkel_conn_string, isolation_level="AUTOCOMMIT", **engine_kwargs)
+        # SQLite connections may be garbage collected, and so reset, in another thread than the one which
+        # used them, e.g. one of the threads of a UDFRunner
+        else:
+            kwargs = dict(engine_kwargs)
+            kwargs['connect_args'] = dict({'check_same_thread': False}, **engine_kwargs.get('connect_args', {}))
+            engine = create_engine(snorkel_conn_string, **kwargs)
+
+        # Note: We keep the Engines inherited from the parent process referenced, so that their
+        # connections are not closed when garbage collected, which would close them for the parent too
+        _engines[pid] = engine
+    return _engines[pid]
+
+
+def configure_engine(**kwargs):
+    """
+    Sets keyword arguments for create_engine, e.g. pool_size=10, and replaces the Engine of the current
+    process; sessionmakers created before, e.g. SnorkelSession, keep using the previous Engine.
+    """
+    engine_kwargs.update(kwargs)
+    engine = _engines.pop(os.getpid(), None)
+    if engine is not None:
+        engine.dispose()
+    return get_engine()
+
+
+# Connections checked out in a forked process from an Engine of its parent (e.g. by a Session created before
+# the fork) are replaced rather than shared, see
+# http://docs.sqlalchemy.org/en/latest/core/pooling.html#using-connection-pools-with-multiprocessing
+@event.listens_for(Pool, "connect")
+def set_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, "checkout")
+def check_connection_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info['pid'] != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError("Connection record belongs to pid %s, attempting to check out in pid %s"
+                                     % (connection_record.info['pid'], pid))
+
+
+# Defines procedure for setting up a sessionmaker, bound to the Engine of the current process
 def new_sessionmaker():
-    
-    # Turning on autocommit for Postgres, see http://oddbird.net/2014/06/14/sqlalchemy-postgres-autocommit/
-    # Otherwise any e.g. query starts a transaction, locking tables... very bad for e.g. multiple notebooks
-    # open, multiple processes, etc.
+    return sessionmaker(bind=get_engine())
+
+
+@contextmanager
+def write_scope(session):
+    """
+    Context manager which runs the writes made with session in the block in one transaction, committed at the
+    end of the block, or rolled back on an error.
+
+    With Postgres, sessions are in AUTOCOMMIT mode (see get_engine), so that reads do not hold locks, but then
+    each write is committed on its own; within a write scope, the session's connection is switched to a
+    READ COMMITTED transaction instead, until the end of the block. With other databases, this just commits.
+    """
     if snorkel_postgres:
-        snorkel_engine = create_engine(snorkel_conn_string, isolation_level="AUTOCOMMIT")
-    else:
-        snorkel_engine = create_engine(snorkel_conn_string)
 
-    # New sessionmaker
-    SnorkelSession = sessionmaker(bind=snorkel_engine)
-    return SnorkelSession
+        # The isolation level can only be set at the start of the session's transaction, so we end the current
+        # one, which holds no locks in AUTOCOMMIT mode
+        session.commit()
+        session.connection(execution_options={'isolation_level': 'READ COMMITTED'})
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
 
 
 # We initialize the engine within the models module because models' schema can depend on
@@ -0,0 +1,22 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+from sqlalchemy import Column, String
+
+from snorkel.models.meta import SnorkelBase
+
+
+class UDFProgress(SnorkelBase):
+    """
+    Records an input object (e.g. a Document or Candidate) completed by a UDF run, so that
+    an interrupted run can be resumed; see UDFRunner.apply.
+    """
+    __tablename__ = 'udf_progress'
+    run           = Column(String, primary_key=True)  # The run name, see UDFRunner.get_run_name
+    item_id       = Column(String, primary_key=True)  # The input object id, see UDF.get_item_id
+
+    def __repr__(self):
+        return "%s (%s : %s)" % (self.__class__.__name__, self.run, self.item_id)
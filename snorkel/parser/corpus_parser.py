@@ -16,6 +16,11 @@ class CorpusParser(UDFRunner):
         super(CorpusParser, self).__init__(CorpusParserUDF,
                                            parser=self.parser,
                                            fn=fn)
+
+    def get_config(self):
+        # The parser holds e.g. server connections, so only its class identifies the configuration
+        return type(self.parser), self.udf_init_kwargs['fn']
+
     def clear(self, session, **kwargs):
         session.query(Context).delete()
         # We cannot cascade up from child contexts to parent Candidates,
@@ -31,6 +36,11 @@ class CorpusParserUDF(UDF):
         self.req_handler = parser.connect()
         self.fn = fn
 
+    @staticmethod
+    def get_item_id(x):
+        doc, text = x
+        return doc.stable_id
+
     def apply(self, x, **kwargs):
         """Given a Document object and its raw text, parse into Sentences"""
         doc, text = x
@@ -5,16 +5,60 @@ from __future__ import unicode_literals
 from future import standard_library
 standard_library.install_aliases()
 from builtins import *
+from future.utils import iteritems
 
-from multiprocessing import Process, JoinableQueue
-from queue import Empty
+import os
+import sys
+import traceback
+import types
+import warnings
+import weakref
+from collections import defaultdict
+from functools import partial
+from hashlib import md5
+from io import BytesIO
+from pickle import Unpickler
+from multiprocessing import Process, JoinableQueue, Queue, Value
+from queue import Empty, Full
+from threading import Event, Thread
+from time import time
 
-from snorkel.models.meta import new_sessionmaker, snorkel_conn_string
-from snorkel.utils import ProgressBar
+from sqlalchemy import func
+from sqlalchemy.orm import Query, class_mapper, object_mapper
+from sqlalchemy.orm.attributes import instance_state
+from sqlalchemy.orm.exc import UnmappedInstanceError
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.sql import select
+
+from snorkel.models.candidate import candidate_subclass, candidate_subclasses
+from snorkel.models.meta import (
+    SnorkelBase, get_engine, new_sessionmaker, snorkel_conn_string, snorkel_postgres, write_scope
+)
+from snorkel.models.progress import UDFProgress
+from snorkel.utils import ProgressBar, clear_context_caches
+
+# The optional cloudpickle package lets UDFPool processes run e.g. functions defined after they started
+try:
+    from cloudpickle import CloudPickler as _Pickler
+except ImportError:
+    from pickle import Pickler as _Pickler
 
 
 QUEUE_TIMEOUT = 3
 
+# Bounds for the default number of input objects sent to a UDF process per queue item
+MAX_CHUNK_SIZE     = 1000
+CHUNKS_PER_PROCESS = 10
+
+# Maximum number of chunks waiting in the input queue, per UDF process
+QUEUED_CHUNKS_PER_PROCESS = 2
+
+# Interval in seconds at which the queue depths and progress of a multi-threaded run are sampled
+STATS_INTERVAL = 1
+
+# Depth below which describe_config no longer describes the attributes of nested objects
+MAX_CONFIG_DEPTH = 8
+
 
 class UDFRunner(object):
     """Class to run UDFs in parallel using simple queue-based multiprocessing setup"""
@@ -22,39 +66,115 @@ class UDFRunner(object):
         self.udf_class       = udf_class
         self.udf_init_kwargs = udf_init_kwargs
         self.udfs            = []
+        self.feed_error      = None
+
+        # The UDFRunStats of the last call to apply
+        self.stats           = None
 
         if hasattr(self.udf_class, 'reduce'):
             self.reducer = self.udf_class(**self.udf_init_kwargs)
         else:
             self.reducer = None
 
-    def apply(self, xs, clear=True, parallelism=None, progress_bar=True, count=None, **kwargs):
+    def apply(self, xs, clear=True, parallelism=None, progress_bar=True, count=None, chunk_size=None,
+              single_writer=None, resume=False, pool=None, **kwargs):
         """
         Apply the given UDF to the set of objects xs, either single or multi-threaded,
-        and optionally calling clear() first.
+        and optionally calling clear() first. xs may be any iterable, including a SQLAlchemy
+        Query, which is streamed rather than loaded into memory up front.
+
+        :param parallelism: Number of UDF processes to run; if None or < 2, runs single-threaded
+        :param count: Number of objects in xs, if xs does not support len()
+        :param chunk_size: Number of objects sent to a UDF process at a time when running
+            multi-threaded; by default chosen from the number of objects and processes
+        :param single_writer: If True, the UDF processes send their outputs back to be written by
+            this process, rather than writing to the database themselves; by default True for SQLite,
+            which does not support concurrent writers. The UDF must then output only new ORM objects or
+            Rows; changes to objects in its session raise an error
+        :param resume: If True, records each completed input object in the UDFProgress table, along
+            with its outputs. If an earlier run with the same name (see get_run_name) recorded any
+            progress, it is resumed: the completed input objects are skipped, and clear() is not called.
+            The progress of a run is cleared once it completes
+        :param pool: A UDFPool whose processes to run the UDF in, rather than starting new ones; the
+            parallelism is that of the pool
+
+        Timers and counters for the run are available afterwards as self.stats, see UDFRunStats.
         """
-        # Clear everything downstream of this UDF if requested
-        if clear:
+        SnorkelSession = new_sessionmaker()
+        session        = SnorkelSession()
+
+        # If resuming, skip the input objects which an earlier run completed. The run name hashes the
+        # UDF config, so it is only computed when needed
+        progress_run = None
+        resuming     = False
+        if resume:
+            run_name     = self.get_run_name(**kwargs)
+            progress_run = run_name
+            done = set(item_id for item_id, in session.query(UDFProgress.item_id)\
+                                                      .filter(UDFProgress.run == run_name))
+            if len(done) > 0:
+                print("Resuming, skipping %s completed..." % len(done))
+                resuming = True
+                xs       = self._skip_done(xs, done)
+                count    = max(0, count - len(done)) if count is not None else None
+
+        # Clear everything downstream of this UDF if requested, including any recorded progress
+        if clear and not resuming:
             print("Clearing existing...")
-            SnorkelSession = new_sessionmaker()
-            session = SnorkelSession()
-            self.clear(session, **kwargs)
-            session.commit()
-            session.close()
+            with write_scope(session):
+                self.clear(session, **kwargs)
+                if progress_run is not None:
+                    session.query(UDFProgress).filter(UDFProgress.run == progress_run)\
+                                              .delete(synchronize_session=False)
+        session.close()
 
         # Execute the UDF
         print("Running UDF...")
+        if pool is not None:
+            parallelism = pool.parallelism
         if parallelism is None or parallelism < 2:
-            self.apply_st(xs, progress_bar, clear=clear, count=count, **kwargs)
+            self.stats = UDFRunStats(1)
+            self.apply_st(xs, progress_bar, clear=clear, count=count, progress_run=progress_run, **kwargs)
         else:
-            self.apply_mt(xs, parallelism, clear=clear, **kwargs)
+            self.stats = UDFRunStats(parallelism)
+            self.apply_mt(xs, parallelism, clear=clear, count=count, chunk_size=chunk_size,
+                          single_writer=single_writer, progress_run=progress_run, progress_bar=progress_bar,
+                          pool=pool, **kwargs)
+        self.stats.finish()
+
+        # The run is complete, so a later run with the same name starts over rather than skipping everything
+        if progress_run is not None:
+            session = SnorkelSession()
+            with write_scope(session):
+                session.query(UDFProgress).filter(UDFProgress.run == progress_run)\
+                                          .delete(synchronize_session=False)
+            session.close()
+
+    def get_run_name(self, **kwargs):
+        """
+        Returns the name under which the progress of a run with the given apply kwargs is recorded. It
+        includes a hash of get_config(), so that runs with e.g. different LFs do not share progress.
+        """
+        return "%s[%s]" % (self.__class__.__name__, config_hash(self.get_config()))
+
+    def get_config(self):
+        """Returns the objects which configure the UDF, e.g. its LFs; by default, the UDF init kwargs"""
+        return self.udf_init_kwargs
+
+    def _skip_done(self, xs, done):
+        for x in stream(xs, MAX_CHUNK_SIZE):
+            if self.udf_class.get_item_id(x) not in done:
+                yield x
 
     def clear(self, session, **kwargs):
         raise NotImplementedError()
 
-    def apply_st(self, xs, progress_bar, count, **kwargs):
+    def apply_st(self, xs, progress_bar, count, progress_run=None, **kwargs):
         """Run the UDF single-threaded, optionally with progress bar"""
-        udf = self.udf_class(**self.udf_init_kwargs)
+        # If the UDF has a reduce step, we use the runner's reducer, which may hold state across calls
+        udf              = self.reducer if self.reducer is not None else self.udf_class(**self.udf_init_kwargs)
+        udf.progress_run = progress_run
+        clear_context_caches()
 
         # Set up ProgressBar if possible
         pb = None
@@ -63,75 +183,554 @@ class UDFRunner(object):
             pb = ProgressBar(n)
 
         # Run single-thread
-        for i, x in enumerate(xs):
-            if pb:
-                pb.bar(i)
+        stats        = self.stats
+        write_time   = udf.buffer.write_time
+        rows_written = udf.buffer.rows_written
+        in_item      = False
+        t            = time()
+        try:
+            for i, x in enumerate(self._prefetched(udf, xs)):
+                stats.stage_times['input'] += time() - t
+                if pb:
+                    pb.bar(i)
 
-            # Apply UDF and add results to the session
-            for y in udf.apply(x, **kwargs):
+                # Apply UDF and add results to the write buffer; the apply timer covers only the UDF
+                in_item = True
+                mark    = udf.buffer.mark()
+                for y in timed(udf.apply(x, **kwargs), stats.stage_times, 'apply'):
+                    stats.outputs += 1
 
-                # Uf UDF has a reduce step, this will take care of the insert; else add to session
-                if hasattr(self.udf_class, 'reduce'):
-                    udf.reduce(y, **kwargs)
-                else:
-                    udf.session.add(y)
+                    # Uf UDF has a reduce step, this will take care of the insert; else add to buffer
+                    if hasattr(self.udf_class, 'reduce'):
+                        t_reduce = time()
+                        udf.reduce(y, **kwargs)
+                        stats.stage_times['reduce'] += time() - t_reduce
+                    else:
+                        udf.buffer.add(y)
+                if progress_run is not None:
+                    udf.buffer.add(udf.get_progress_row(x))
+                in_item = False
+                stats.items += 1
+                udf.buffer.maybe_flush()
+                t = time()
 
-        # Commit session and close progress bar if applicable
-        udf.session.commit()
+        # If the run fails, we keep the completed items so that it can be resumed, dropping the outputs of
+        # the item being applied, if any
+        except BaseException:
+            if progress_run is not None:
+                if in_item:
+                    udf.buffer.discard(mark)
+                udf.buffer.flush()
+            raise
+
+        # Write out and commit, and close progress bar if applicable
+        udf.buffer.flush()
         if pb:
             pb.close()
 
-    def apply_mt(self, xs, parallelism, **kwargs):
-        """Run the UDF multi-threaded using python multiprocessing"""
-        if snorkel_conn_string.startswith('sqlite'):
-            raise ValueError('Multiprocessing with SQLite is not supported. Please use a different database backend,'
-                             ' such as PostgreSQL.')
+        stats.stage_times['commit'] = udf.buffer.write_time - write_time
+        stats.rows_written          = udf.buffer.rows_written - rows_written
 
-        # Fill a JoinableQueue with input objects
-        in_queue = JoinableQueue()
-        for x in xs:
-            in_queue.put(x)
+    def _prefetched(self, udf, xs):
+        """Iterates over xs, calling udf.prefetch on each chunk of up to MAX_CHUNK_SIZE input objects first"""
+        for chunk in chunks(stream(xs, MAX_CHUNK_SIZE), MAX_CHUNK_SIZE):
+            udf.prefetch(chunk)
+            for x in chunk:
+                yield x
 
-        # If the UDF has a reduce step, we collect the output of apply in a Queue
-        out_queue = None
-        if hasattr(self.udf_class, 'reduce'):
-            out_queue = JoinableQueue()
+    def apply_mt(self, xs, parallelism, count=None, chunk_size=None, single_writer=None, progress_run=None,
+                 progress_bar=False, pool=None, **kwargs):
+        """Run the UDF multi-threaded using python multiprocessing, optionally in the processes of a UDFPool"""
+        sqlite = snorkel_conn_string.startswith('sqlite')
+        if single_writer is None:
+            single_writer = sqlite
+        elif sqlite and not single_writer:
+            raise ValueError('Multiprocessing with SQLite is only supported with single_writer=True. Please use'
+                             ' a different database backend, such as PostgreSQL, for concurrent writers.')
 
-        # Start UDF Processes
-        for i in range(parallelism):
-            udf              = self.udf_class(in_queue=in_queue, out_queue=out_queue, **self.udf_init_kwargs)
-            udf.apply_kwargs = kwargs
-            self.udfs.append(udf)
+        # Input objects are sent in chunks, to amortize the IPC cost over many objects
+        if chunk_size is None:
+            n          = count if count is not None else len(xs) if hasattr(xs, '__len__') else None
+            chunk_size = get_chunk_size(n, parallelism)
 
-        # Start the UDF processes, and then join on their completion
-        for udf in self.udfs:
-            udf.start()
+        # If the UDF has a reduce step, or in single-writer mode, we collect the output of apply in a
+        # Queue, one list per chunk, to be handled by this process
+        hand_back = self.reducer is not None or single_writer
 
-        # If there is a reduce step, do now on this thread
-        if hasattr(self.udf_class, 'reduce'):
-            while any([udf.is_alive() for udf in self.udfs]):
-                while True:
+        # Send the run to the processes of the pool, if it can be pickled
+        # Note: Queries in the apply kwargs (e.g. the cids_query of an Annotator) are bound to a session of
+        # this process, and so are not sent
+        if pool is not None:
+            try:
+                run_kwargs = dict((k, v) for k, v in iteritems(kwargs) if not isinstance(v, Query))
+                udf_spec   = dumps_spec((self.udf_class, self.udf_init_kwargs))
+                run_spec   = dumps_spec((run_kwargs, progress_run))
+            except Exception as e:
+                warnings.warn("Cannot send the UDF to the pool processes (%s: %s), starting new processes instead."
+                              % (type(e).__name__, e))
+                pool = None
+        if pool is not None:
+            pool.start()
+            in_queue               = pool.in_queue
+            out_queue              = pool.out_queue if hand_back else None
+            stats_queue            = pool.stats_queue
+            items_done             = pool.items_done
+            items_done.value       = 0
+            self.udfs              = list(pool.workers)
+            for worker in pool.workers:
+                worker.control_queue.put((udf_spec, run_spec, hand_back))
+
+        # Otherwise, start new UDF processes; the input queue is bounded, so that the producer thread
+        # blocks while the UDF processes catch up
+        else:
+            in_queue  = JoinableQueue(maxsize=parallelism * QUEUED_CHUNKS_PER_PROCESS)
+            out_queue = JoinableQueue(maxsize=parallelism * QUEUED_CHUNKS_PER_PROCESS) if hand_back else None
+
+            # The UDF processes send their timers and counters once done, and count the completed items
+            stats_queue = Queue()
+            items_done  = Value('l', 0)
+            for i in range(parallelism):
+                udf              = self.udf_class(in_queue=in_queue, out_queue=out_queue, **self.udf_init_kwargs)
+                udf.apply_kwargs = kwargs
+                udf.progress_run = progress_run
+                udf.stats_queue  = stats_queue
+                udf.items_done   = items_done
+                self.udfs.append(udf)
+            for udf in self.udfs:
+                udf.start()
+
+        # Start the threads streaming xs to the UDF processes and monitoring the run
+        # Note: The threads are started after forking, so that no process inherits their locks
+        stats           = self.stats
+        self.feed_error = None
+        producer        = Thread(target=self._feed, args=(xs, in_queue, chunk_size, parallelism))
+        producer.daemon = True
+        producer.start()
+        monitor_done    = Event()
+        monitor         = Thread(target=self._monitor,
+                                 args=(in_queue, out_queue, items_done, count, progress_bar, monitor_done))
+        monitor.daemon  = True
+        monitor.start()
+
+        try:
+            # If there is a reduce step, do now on this thread; else write out the Rows sent by the UDFs
+            if out_queue is not None:
+                if self.reducer is not None:
+                    writer = self.reducer.buffer
+                else:
+                    writer = self.udf_class.write_buffer_class(new_sessionmaker()())
+                write_time   = writer.write_time
+                rows_written = writer.rows_written
+
+                # Each UDF process sends None once it is done
+                n_done = 0
+                while n_done < parallelism:
                     try:
-                        y = out_queue.get(True, QUEUE_TIMEOUT)
-                        self.reducer.reduce(y, **kwargs)
-                        out_queue.task_done()
+                        ys = out_queue.get(True, QUEUE_TIMEOUT)
                     except Empty:
+                        if not any([udf.is_alive() for udf in self.udfs]):
+                            break
+                        continue
+                    if ys is None:
+                        n_done += 1
+                    else:
+                        t = time()
+                        for y in ys:
+                            if self.reducer is not None and not isinstance(y, Row):
+                                self.reducer.reduce(y, **kwargs)
+                            else:
+                                writer.add(y)
+                        stats.stage_times['reduce' if self.reducer is not None else 'commit'] += time() - t
+                        writer.maybe_flush()
+                    out_queue.task_done()
+                writer.flush()
+                writer.session.close()
+
+                stats.stage_times['commit'] += writer.write_time - write_time
+                stats.rows_written          += writer.rows_written - rows_written
+
+            # Collect the worker stats; each UDF process sends them once done, or the error it failed with
+            errors = []
+            while len(stats.workers) + len(errors) < parallelism:
+                try:
+                    worker = stats_queue.get(True, QUEUE_TIMEOUT)
+                except Empty:
+                    if not any([udf.is_alive() for udf in self.udfs]):
                         break
-                self.reducer.session.commit()
-            self.reducer.session.close()
+                    continue
+                if 'error' in worker:
+                    errors.append(worker['error'])
+                else:
+                    stats.add_worker(worker)
+            stats.items = items_done.value
+
+            # Processes which exited without sending either crashed, e.g. were killed
+            if len(stats.workers) + len(errors) < parallelism:
+                errors.append("%s UDF process(es) exited without reporting, with exit codes %s." % (
+                    parallelism - len(stats.workers) - len(errors), [udf.exitcode for udf in self.udfs]))
+            producer.join()
 
-        # Otherwise just join on the UDF.apply actions
+        # If the run fails, the pool queues may still hold some of its items, so we stop the pool, which is
+        # restarted on next use
+        except BaseException:
+            if pool is not None:
+                pool.terminate()
+            raise
+
+        # Terminate the processes, unless they belong to the pool
+        finally:
+            monitor_done.set()
+            monitor.join()
+            if pool is None:
+                for udf in self.udfs:
+                    if udf.is_alive():
+                        udf.terminate()
+                for udf in self.udfs:
+                    udf.join()
+            self.udfs = []
+        if len(errors) > 0:
+            raise RuntimeError("UDF process failed:\n%s" % errors[0])
+        if self.feed_error is not None:
+            raise self.feed_error
+
+    def _feed(self, xs, in_queue, chunk_size, parallelism):
+        """Streams chunks of xs into in_queue, followed by an end-of-stream sentinel for each UDF process"""
+        stage_times = self.stats.stage_times
+        try:
+            t = time()
+            for chunk in chunks(stream(xs, chunk_size), chunk_size):
+                t_put = time()
+                stage_times['input'] += t_put - t
+                self._put(in_queue, chunk)
+                t = time()
+                stage_times['queue'] += t - t_put
+                self.stats.chunks    += 1
+        except BaseException as e:
+            self.feed_error = e
+
+        # The sentinels are sent even if reading xs failed, so that the UDF processes do not wait for more
+        finally:
+            try:
+                for i in range(parallelism):
+                    self._put(in_queue, None)
+            except RuntimeError:
+                pass
+
+    def _put(self, queue, item):
+        """Blocking put onto a bounded queue, which gives up if all of the UDF processes have exited"""
+        while True:
+            try:
+                queue.put(item, True, QUEUE_TIMEOUT)
+                return
+            except Full:
+                if not any([udf.is_alive() for udf in self.udfs]):
+                    raise RuntimeError("All UDF processes exited before consuming their input.")
+
+    def _monitor(self, in_queue, out_queue, items_done, count, progress_bar, done):
+        """Samples the queue depths and completed items every STATS_INTERVAL secs, optionally printing them"""
+        while not done.wait(STATS_INTERVAL):
+            self.stats.sample(qsize(in_queue), qsize(out_queue), items_done.value)
+            if progress_bar:
+                sys.stdout.write("\r" + self.stats.progress(count))
+                sys.stdout.flush()
+        if progress_bar:
+            sys.stdout.write("\r" + self.stats.progress(count) + "\n\n")
+            sys.stdout.flush()
+
+
+class UDFRunStats(object):
+    """
+    Timers and counters collected by a UDFRunner.apply call, available afterwards as UDFRunner.stats.
+
+    stage_times holds the total seconds spent in each stage of the run, summed over processes:
+        * input: reading the input objects, e.g. streaming a Query
+        * queue: blocked on a full queue, i.e. sending inputs to or outputs from the UDF processes
+        * apply: running UDF.apply
+        * reduce: running UDF.reduce, for UDFs with a reduce step
+        * commit: writing and committing outputs to the database
+    For multi-threaded runs, queue_depths holds samples of (secs since start, input queue depth,
+    output queue depth, items completed), with the depths in chunks, and workers holds the timers and
+    counters of each UDF process, including the time it was busy (apply and commit) and idle (waiting
+    for input).
+    """
+    def __init__(self, parallelism):
+        self.parallelism  = parallelism
+        self.start_time   = time()
+        self.end_time     = None
+        self.items        = 0
+        self.chunks       = 0
+        self.outputs      = 0
+        self.rows_written = 0
+        self.stage_times  = defaultdict(float)
+        self.queue_depths = []
+        self.workers      = []
+
+    def finish(self):
+        self.end_time = time()
+
+    @property
+    def elapsed(self):
+        return (self.end_time or time()) - self.start_time
+
+    @property
+    def items_per_sec(self):
+        return self.items / self.elapsed if self.elapsed > 0 else 0.0
+
+    def add_worker(self, worker):
+        """Adds the timers and counters sent by a UDF process once it is done"""
+        self.workers.append(worker)
+        self.outputs      += worker['outputs']
+        self.rows_written += worker['rows_written']
+        for stage in ['apply', 'queue', 'commit']:
+            self.stage_times[stage] += worker[stage]
+
+    def sample(self, in_depth, out_depth, items):
+        self.items = items
+        self.queue_depths.append((time() - self.start_time, in_depth, out_depth, items))
+
+    def progress(self, count=None):
+        """Returns a one-line progress report"""
+        done = "%s/%s" % (self.items, count) if count is not None else str(self.items)
+        line = "%s items, %.1f items/sec" % (done, self.items_per_sec)
+        if len(self.queue_depths) > 0 and self.queue_depths[-1][1] is not None:
+            line += ", %s chunks queued" % self.queue_depths[-1][1]
+        return line
+
+    def to_dict(self):
+        return {
+            'parallelism'   : self.parallelism,
+            'elapsed'       : self.elapsed,
+            'items'         : self.items,
+            'items_per_sec' : self.items_per_sec,
+            'chunks'        : self.chunks,
+            'outputs'       : self.outputs,
+            'rows_written'  : self.rows_written,
+            'stage_times'   : dict(self.stage_times),
+            'queue_depths'  : list(self.queue_depths),
+            'workers'       : list(self.workers),
+        }
+
+    def __repr__(self):
+        lines = [
+            "%s items in %.2f secs (%.1f items/sec), %s outputs, %s rows written, parallelism=%s" % (
+                self.items, self.elapsed, self.items_per_sec, self.outputs, self.rows_written,
+                self.parallelism)
+        ]
+        for stage in ['input', 'queue', 'apply', 'reduce', 'commit']:
+            lines.append("  %-8s %8.2f secs" % (stage, self.stage_times[stage]))
+        for w in self.workers:
+            lines.append("  %s: %s items, busy %.2f secs, idle %.2f secs" % (
+                w['name'], w['items'], w['apply'] + w['commit'], w['idle']))
+        return "\n".join(lines)
+
+
+class Row(object):
+    """
+    A row to insert for the mapped class cls, given by its column attribute values.
+    A value may also be another Row, whose primary key is filled in once it is written.
+    """
+    def __init__(self, cls, **values):
+        self.cls    = cls
+        self.values = values
+        self.id     = values.get('id')
+
+    def get_mapping(self):
+        mapping = dict((k, v.id if isinstance(v, Row) else v) for k, v in iteritems(self.values))
+
+        # Set the polymorphic identity, e.g. the type of a Context, as the ORM would
+        mapper = class_mapper(self.cls)
+        if mapper.polymorphic_on is not None:
+            mapping.setdefault(mapper.get_property_by_column(mapper.polymorphic_on).key,
+                               mapper.polymorphic_identity)
+        return mapping
+
+    # Rows are sent between processes with their class by name, since e.g. Candidate subclasses
+    # cannot be pickled directly
+    def __getstate__(self):
+        return self.cls.__name__, self.values, self.id
+
+    def __setstate__(self, state):
+        cls_name, self.values, self.id = state
+        self.cls = SnorkelBase._decl_class_registry[cls_name]
+
+    def __repr__(self):
+        return "Row(%s, %s)" % (self.cls.__name__, self.values)
+
+
+class WriteBuffer(object):
+    """
+    Collects the outputs of a UDF and writes them to the database in bulk, using Core executemany
+    statements rather than the ORM unit of work.
+
+    Outputs may be Rows, or new ORM objects, which are converted to Rows along with any new objects
+    they reference (e.g. the Document of a new Sentence). Objects which are already persistent are
+    added to the session as usual.
+
+    The buffer is written and committed by flush(); maybe_flush() does so once flush_rows Rows have
+    been collected or flush_secs seconds have passed since the last flush. The UDF runners call
+    maybe_flush() only between input objects, so all outputs of an input object are written together.
+    """
+    def __init__(self, session, flush_rows=5000, flush_secs=30):
+        self.session      = session
+        self.flush_rows   = flush_rows
+        self.flush_secs   = flush_secs
+        self.rows         = []
+        self.rows_written = 0
+        self.write_time   = 0.0
+        self.last_flush   = time()
+
+        # Maps id(obj) -> (weak reference to obj, Row) for the converted ORM objects, kept across flushes
+        # so that an object referenced again later (e.g. a shared parent) is not inserted twice
+        self.converted    = {}
+
+    def add(self, y):
+        if isinstance(y, Row):
+            self.rows.append(y)
+            return
+        try:
+            state = instance_state(y)
+        except (AttributeError, UnmappedInstanceError):
+            raise ValueError("Cannot write UDF output of type %s" % type(y))
+        if state.has_identity or self._has_children(state):
+            self.session.add(y)
         else:
-            for i, udf in enumerate(self.udfs):
-                udf.join()
+            self._convert(y)
+
+    def __len__(self):
+        """The number of buffered writes"""
+        return len(self.rows)
+
+    def mark(self):
+        """Returns a mark of the buffered writes, see discard"""
+        return len(self.rows)
+
+    def discard(self, mark):
+        """
+        Drops the writes buffered since mark was taken, e.g. the outputs of a failed input object. ORM
+        objects added to the session as is are not dropped.
+        """
+        dropped = set(id(row) for row in self.rows[mark:])
+        del self.rows[mark:]
+        for key, (_, row) in list(iteritems(self.converted)):
+            if id(row) in dropped:
+                del self.converted[key]
+
+    def maybe_flush(self):
+        if len(self) >= self.flush_rows or time() - self.last_flush >= self.flush_secs:
+            self.flush()
 
-        # Terminate and flush the processes
-        for udf in self.udfs:
-            udf.terminate()
-        self.udfs = []
+    def take_rows(self):
+        """
+        Returns and clears the buffered Rows, e.g. to send them to another process to write. Since the
+        Rows are written elsewhere, ORM objects referenced again afterwards are converted again.
+        """
+        rows, self.rows = self.rows, []
+        self.converted  = {}
+        return rows
+
+    def flush(self):
+        """Writes the buffered Rows to the database in one transaction, and commits"""
+        t = time()
+        with write_scope(self.session):
+            n = self.write()
+        self.rows_written += n
+        self.last_flush    = time()
+        self.write_time   += self.last_flush - t
+
+    def write(self):
+        """Writes the buffered Rows to the database, without committing; returns the number of rows written"""
+        rows, self.rows = self.rows, []
+
+        # Rows reference only Rows collected before them (or written in an earlier flush). We write
+        # them in levels by reference depth, so that all referenced ids are known before each insert.
+        # The ids of converted ORM objects are also kept, since they may be referenced in a later flush
+        depth      = {}
+        referenced = set()
+        for key, (ref, row) in list(iteritems(self.converted)):
+            if ref() is None:
+                del self.converted[key]
+            else:
+                referenced.add(id(row))
+        levels     = defaultdict(lambda: defaultdict(list))
+        for row in rows:
+            d = 0
+            for v in row.values.values():
+                if isinstance(v, Row) and v.id is None:
+                    d = max(d, depth[id(v)] + 1)
+                    referenced.add(id(v))
+            depth[id(row)] = d
+            levels[d][row.cls].append(row)
+        for d in sorted(levels.keys()):
+            for cls, cls_rows in iteritems(levels[d]):
+                self._insert(cls, cls_rows, any(id(row) in referenced for row in cls_rows))
+        return len(rows)
+
+    def _insert(self, cls, rows, referenced):
+        mapper   = class_mapper(cls)
+        mappings = [row.get_mapping() for row in rows]
+
+        # We need the primary keys of new rows if they are referenced, or if the class is mapped to
+        # several tables (joined table inheritance, e.g. Span -> Context)
+        pk      = mapper.primary_key
+        pk_key  = mapper.get_property_by_column(pk[0]).key if len(pk) == 1 else None
+        missing = [m for m in mappings if m.get(pk_key) is None] if pk_key is not None else []
+        need_ids = len(missing) > 0 and (referenced or len(mapper.tables) > 1)
+
+        # With Postgres, we reserve ids from the sequence in one query, so that all tables can be
+        # written with executemany; otherwise the rows which need ids are inserted one at a time
+        if need_ids and snorkel_postgres:
+            seq = '%s_%s_seq' % (pk[0].table.name, pk[0].name)
+            ids = self.session.execute(
+                select([func.nextval(seq)]).select_from(func.generate_series(1, len(missing))))
+            for m, (i,) in zip(missing, ids):
+                m[pk_key] = i
+            need_ids = False
+        self.session.bulk_insert_mappings(cls, mappings, return_defaults=need_ids)
+
+        if pk_key is not None:
+            for row, m in zip(rows, mappings):
+                row.id = m.get(pk_key)
+
+    def _has_children(self, state):
+        """Whether an ORM object has new related objects in collections, which only the ORM can cascade"""
+        for rel in state.mapper.relationships:
+            if rel.direction != MANYTOONE and len(state.dict.get(rel.key) or []) > 0:
+                return True
+        return False
+
+    def _convert(self, obj):
+        """Returns a Row for a new ORM object (or the id of a persistent one), adding the Row to the buffer"""
+        state = instance_state(obj)
+        if state.has_identity:
+            return state.identity[0]
+        if id(obj) in self.converted and self.converted[id(obj)][0]() is obj:
+            return self.converted[id(obj)][1]
+
+        # Column values which are set, including to None unless for the primary key; relationships to
+        # other objects are replaced by their Rows / ids
+        mapper = object_mapper(obj)
+        values = {}
+        for prop in mapper.column_attrs:
+            if prop.key in state.dict:
+                v = state.dict[prop.key]
+                if v is not None or not any(c.primary_key for c in prop.columns):
+                    values[prop.key] = v
+        for rel in mapper.relationships:
+            other = state.dict.get(rel.key)
+            if rel.direction == MANYTOONE and other is not None:
+                for local_col, remote_col in rel.local_remote_pairs:
+                    values[mapper.get_property_by_column(local_col).key] = self._convert(other)
+
+        row = Row(mapper.class_, **values)
+        self.converted[id(obj)] = (weakref.ref(obj), row)
+        self.rows.append(row)
+        return row
 
 
 class UDF(Process):
+    # The class used to collect and write the outputs of apply
+    write_buffer_class = WriteBuffer
+
     def __init__(self, in_queue=None, out_queue=None):
         """
         in_queue: A Queue of input objects to process; primarily for running in parallel
@@ -141,35 +740,394 @@ class UDF(Process):
         self.in_queue     = in_queue
         self.out_queue    = out_queue
 
-        # Each UDF starts its own Engine
-        # See http://docs.sqlalchemy.org/en/latest/core/pooling.html#using-connection-pools-with-multiprocessing
+        # The session uses the Engine of the process; when run as a Process, it is rebound in run()
+        # Note: The input objects stay loaded when the buffer commits, e.g. those loaded in bulk by prefetch
         SnorkelSession = new_sessionmaker()
-        self.session   = SnorkelSession()
+        self.session   = SnorkelSession(expire_on_commit=False)
+        self.buffer    = self.write_buffer_class(self.session)
 
-        # We use a workaround to pass in the apply kwargs
+        # We use a workaround to pass in the apply kwargs, the run name under which to record progress,
+        # and where to send stats when running in parallel
         self.apply_kwargs = {}
+        self.progress_run = None
+        self.stats_queue  = None
+        self.items_done   = None
 
     def run(self):
         """
-        This method is called when the UDF is run as a Process in a multiprocess setting
-        The basic routine is: get from JoinableQueue, apply, put / add outputs, loop
+        This method is called when the UDF is run as a Process in a multiprocess setting. If the UDF
+        fails, the error is sent in place of its stats, so that the UDFRunner raises it.
+        """
+        try:
+            self.process_queue()
+        except Exception:
+            if self.stats_queue is None:
+                raise
+            self.stats_queue.put({'name': self.name, 'error': traceback.format_exc()})
+            if self.out_queue is not None:
+                self.out_queue.put(None)
+
+    def process_queue(self):
+        """
+        The basic routine is: get a chunk from JoinableQueue, apply, put / add outputs, loop
+        until the end-of-stream sentinel (None) is received
         """
+        reduces    = hasattr(self, 'reduce')
+        parent_pid = os.getppid()
+        stats   = defaultdict(float)
+
+        # The UDF was created in the parent process, so we switch the session to the Engine of this one
+        # See http://docs.sqlalchemy.org/en/latest/core/pooling.html#using-connection-pools-with-multiprocessing
+        self.session.bind = get_engine()
+        clear_context_caches()
+
+        # The UDF may be run several times in a UDFPool process, so the buffer counters are per run
+        self.buffer.rows_written = 0
+        self.buffer.write_time   = 0.0
+        self.end_of_stream       = False
         while True:
-            try:
-                x = self.in_queue.get(True, QUEUE_TIMEOUT)
+            t  = time()
+            xs = get_from_parent(self.in_queue, parent_pid)
+            t_chunk = time()
+            stats['idle'] += t_chunk - t
+            if xs is None:
+                self.end_of_stream = True
+                self.in_queue.task_done()
+                break
+            ys = []
+            self.prefetch(xs)
+            for x in xs:
                 for y in self.apply(x, **self.apply_kwargs):
+                    stats['outputs'] += 1
 
-                    # If an out_queue is provided, add to that, else add to session
-                    if self.out_queue is not None:
-                        self.out_queue.put(y, True, QUEUE_TIMEOUT)
+                    # Outputs to be reduced are sent back as is; others go to the write buffer
+                    if reduces:
+                        ys.append(y)
                     else:
-                        self.session.add(y)
-                self.in_queue.task_done()
-            except Empty:
-                break
-        self.session.commit()
+                        self.buffer.add(y)
+
+                # Progress is recorded along with the outputs, so that they are committed together
+                if self.progress_run is not None:
+                    if reduces:
+                        ys.append(self.get_progress_row(x))
+                    else:
+                        self.buffer.add(self.get_progress_row(x))
+                if self.out_queue is None:
+                    self.buffer.maybe_flush()
+
+            # Hand back the outputs of the whole chunk at once; in single-writer mode, as Rows
+            t = time()
+            stats['apply'] += t - t_chunk
+            if self.out_queue is not None:
+                if not reduces:
+                    ys = self.buffer.take_rows()
+
+                # Changes made through the session, e.g. to persistent objects, cannot be handed back
+                if self.session.new or self.session.dirty or self.session.deleted:
+                    raise RuntimeError("The UDF changed objects in its session, which cannot be sent back to be "
+                                       "written in single-writer mode; it must output new objects or Rows.")
+                if len(ys) > 0:
+                    self.out_queue.put(ys)
+            stats['queue']  += time() - t
+            stats['items']  += len(xs)
+            stats['chunks'] += 1
+            if self.items_done is not None:
+                with self.items_done.get_lock():
+                    self.items_done.value += len(xs)
+            self.in_queue.task_done()
+
+        # The apply timer includes the writes made between chunks, which are reported separately
+        stats['apply'] -= self.buffer.write_time
+        self.buffer.flush()
         self.session.close()
 
+        # Send the stats before the end-of-stream sentinel
+        if self.stats_queue is not None:
+            worker = {'name': self.name, 'commit': self.buffer.write_time, 'rows_written': self.buffer.rows_written}
+            for k in ['items', 'chunks', 'outputs']:
+                worker[k] = int(stats[k])
+            for k in ['idle', 'apply', 'queue']:
+                worker[k] = stats[k]
+            self.stats_queue.put(worker)
+        if self.out_queue is not None:
+            self.out_queue.put(None)
+
+    def prefetch(self, xs):
+        """Called with each chunk of input objects before they are applied, e.g. to load data for them in bulk"""
+        pass
+
     def apply(self, x, **kwargs):
         """This function takes in an object, and returns a generator / set / list"""
         raise NotImplementedError()
+
+    @staticmethod
+    def get_item_id(x):
+        """Returns a string identifying the input object x across runs, needed to resume runs"""
+        raise NotImplementedError("This UDF does not support resuming runs.")
+
+    def get_progress_row(self, x):
+        return Row(UDFProgress, run=self.progress_run, item_id=self.get_item_id(x))
+
+
+class UDFPool(object):
+    """
+    A pool of long-lived UDF processes, which can be shared across UDFRunner.apply calls, including
+    by runners of different UDFs (e.g. several Annotators), by passing pool=... to apply; this avoids
+    starting new processes for each call. The processes are started on first use, and stopped by close(),
+    or at the end of a with block.
+
+    The UDF class, its init kwargs and the apply kwargs are sent to the processes for each call, and so
+    must be picklable; with the optional cloudpickle package, this includes e.g. LFs defined after the
+    processes were started. Calls which cannot be sent fall back to starting new processes.
+    """
+    def __init__(self, parallelism):
+        self.parallelism = parallelism
+        self.workers     = []
+
+    def start(self):
+        """Starts the processes, if they are not all running"""
+        if len(self.workers) > 0 and all(w.is_alive() for w in self.workers):
+            return
+        self.terminate()
+        self.in_queue    = JoinableQueue(maxsize=self.parallelism * QUEUED_CHUNKS_PER_PROCESS)
+        self.out_queue   = JoinableQueue(maxsize=self.parallelism * QUEUED_CHUNKS_PER_PROCESS)
+        self.stats_queue = Queue()
+        self.items_done  = Value('l', 0)
+        self.workers     = [UDFPoolProcess(self.in_queue, self.out_queue, self.stats_queue, self.items_done)
+                            for i in range(self.parallelism)]
+        for w in self.workers:
+            w.start()
+
+    def close(self):
+        """Stops the processes once they are done with the current call"""
+        for w in self.workers:
+            if w.is_alive():
+                w.control_queue.put(None)
+        for w in self.workers:
+            w.join(QUEUE_TIMEOUT)
+        self.terminate()
+
+    def terminate(self):
+        for w in self.workers:
+            if w.is_alive():
+                w.terminate()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class UDFPoolProcess(Process):
+    """
+    A process of a UDFPool. For each call, it receives the UDF to run on its control queue, and then
+    runs it on the pool queues until the end-of-stream sentinel, keeping the UDF for the next call if the
+    same one is sent again.
+    """
+    def __init__(self, in_queue, out_queue, stats_queue, items_done):
+        Process.__init__(self)
+        self.daemon        = True
+        self.control_queue = Queue()
+        self.in_queue      = in_queue
+        self.out_queue     = out_queue
+        self.stats_queue   = stats_queue
+        self.items_done    = items_done
+
+    def run(self):
+        udf_spec, udf = None, None
+        parent_pid    = os.getppid()
+        while True:
+            spec = self.control_queue.get()
+            if spec is None:
+                break
+            next_udf_spec, run_spec, hand_back = spec
+            try:
+                if next_udf_spec != udf_spec:
+                    if udf is not None:
+                        udf.session.close()
+                    udf_spec, udf = None, None
+                    udf_class, udf_init_kwargs = loads_spec(next_udf_spec)
+                    udf      = udf_class(in_queue=self.in_queue, **udf_init_kwargs)
+                    udf_spec = next_udf_spec
+                udf.apply_kwargs, udf.progress_run = loads_spec(run_spec)
+                udf.out_queue   = self.out_queue if hand_back else None
+                udf.stats_queue = self.stats_queue
+                udf.items_done  = self.items_done
+                udf.process_queue()
+
+            # Consume the rest of the call's input, so that the pool queues are left empty for the next
+            # call, and report the error in place of the stats
+            except Exception:
+                error = traceback.format_exc()
+                if udf is None or not udf.end_of_stream:
+                    while get_from_parent(self.in_queue, parent_pid) is not None:
+                        pass
+                if udf is not None:
+                    udf.session.close()
+                udf_spec, udf = None, None
+                self.stats_queue.put({'name': self.name, 'error': error})
+                if hand_back:
+                    self.out_queue.put(None)
+
+
+class SpecPickler(_Pickler):
+    """Pickles mapped classes by name, since e.g. Candidate subclasses cannot be pickled directly"""
+    def persistent_id(self, obj):
+        if isinstance(obj, type) and issubclass(obj, SnorkelBase):
+            name = obj.__name__
+            if name in candidate_subclasses and candidate_subclasses[name][0] is obj:
+                return 'candidate_subclass', name, candidate_subclasses[name][1]
+            return 'class', name, None
+        return None
+
+
+class SpecUnpickler(Unpickler):
+    def persistent_load(self, pid):
+        kind, name, class_spec = pid
+
+        # The Candidate subclass may have been defined after this process started
+        if kind == 'candidate_subclass':
+            return candidate_subclass(name, *class_spec)
+        return SnorkelBase._decl_class_registry[name]
+
+
+def dumps_spec(obj):
+    f = BytesIO()
+    SpecPickler(f, 2).dump(obj)
+    return f.getvalue()
+
+
+def loads_spec(s):
+    return SpecUnpickler(BytesIO(s)).load()
+
+
+def get_chunk_size(n, parallelism):
+    """
+    Returns a default chunk size for n input objects (None if unknown) split among parallelism
+    processes: enough chunks per process to balance the load, but no larger than MAX_CHUNK_SIZE
+    """
+    if n is None:
+        return MAX_CHUNK_SIZE
+    return int(max(1, min(MAX_CHUNK_SIZE, n // (parallelism * CHUNKS_PER_PROCESS))))
+
+
+def stream(xs, batch_size):
+    """
+    Iterates over xs. A SQLAlchemy Query is run in a new session and its results are fetched
+    batch_size rows at a time, rather than all at once.
+    """
+    if not isinstance(xs, Query):
+        for x in xs:
+            yield x
+        return
+
+    session = new_sessionmaker()()
+    try:
+        # Streaming results from Postgres requires a transaction, so opt out of AUTOCOMMIT
+        if snorkel_postgres:
+            session.connection(execution_options={'isolation_level': 'READ COMMITTED'})
+        for x in xs.with_session(session).yield_per(batch_size):
+            yield x
+    finally:
+        session.close()
+
+
+def qsize(queue):
+    """Returns the approximate size of a multiprocessing queue, or None if unknown or not supported"""
+    if queue is None:
+        return None
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return None
+
+
+def timed(ys, stage_times, stage):
+    """Yields the elements of the iterable ys, adding the time spent producing them to stage_times[stage]"""
+    ys = iter(ys)
+    while True:
+        t = time()
+        try:
+            y = next(ys)
+        except StopIteration:
+            stage_times[stage] += time() - t
+            return
+        stage_times[stage] += time() - t
+        yield y
+
+
+def describe_config(obj, _seen=None, _depth=0):
+    """
+    Returns a description of obj which is the same across processes: functions by name and a hash of their
+    code, classes by name, containers by their elements, and other objects by their class and attributes.
+    Objects already being described, e.g. in a reference cycle, and objects nested more than
+    MAX_CONFIG_DEPTH levels deep are described by their class only
+    """
+    if isinstance(obj, types.FunctionType):
+        return "%s.%s<%s>" % (obj.__module__, getattr(obj, '__qualname__', obj.__name__),
+                              md5(_describe_code(obj.__code__)).hexdigest()[:10])
+    if isinstance(obj, (type, types.BuiltinFunctionType)):
+        return "%s.%s" % (obj.__module__, getattr(obj, '__qualname__', obj.__name__))
+    if not isinstance(obj, (list, tuple, set, frozenset, dict, partial, types.MethodType))\
+       and not hasattr(obj, '__dict__'):
+        return repr(obj)
+
+    # Containers and objects with attributes: guard against cycles and deep object graphs
+    _seen = set() if _seen is None else _seen
+    if id(obj) in _seen or _depth >= MAX_CONFIG_DEPTH:
+        return "%s(...)" % describe_config(type(obj))
+    _seen.add(id(obj))
+    try:
+        describe = lambda x: describe_config(x, _seen, _depth + 1)
+        if isinstance(obj, types.MethodType):
+            return "%s.%s" % (describe(obj.__self__), obj.__name__)
+        if isinstance(obj, partial):
+            return "partial(%s, %s, %s)" % (describe(obj.func), describe(obj.args), describe(obj.keywords or {}))
+        if isinstance(obj, (list, tuple)):
+            return "[%s]" % ", ".join(describe(x) for x in obj)
+        if isinstance(obj, (set, frozenset)):
+            return "{%s}" % ", ".join(sorted(describe(x) for x in obj))
+        if isinstance(obj, dict):
+            return "{%s}" % ", ".join(sorted("%s: %s" % (describe(k), describe(v)) for k, v in iteritems(obj)))
+        return "%s(%s)" % (describe_config(type(obj)), describe(vars(obj)))
+    finally:
+        _seen.discard(id(obj))
+
+
+def _describe_code(code):
+    """Returns the bytecode, names and constants of a code object, including those of nested code objects"""
+    consts = [_describe_code(c) if isinstance(c, types.CodeType) else repr(c).encode('utf-8')
+              for c in code.co_consts]
+    return b'|'.join([code.co_code, ' '.join(code.co_names).encode('utf-8')] + consts)
+
+
+def config_hash(obj):
+    """Returns a short hash of describe_config(obj)"""
+    return md5(describe_config(obj).encode('utf-8')).hexdigest()[:10]
+
+
+def get_from_parent(queue, parent_pid):
+    """
+    Blocking get from a queue fed by the parent process with id parent_pid, which gives up if the parent
+    exits, rather than waiting forever for input which will not come
+    """
+    while True:
+        try:
+            return queue.get(True, QUEUE_TIMEOUT)
+        except Empty:
+            if os.getppid() != parent_pid:
+                raise RuntimeError("The parent process exited before sending the end of the UDF input.")
+
+
+def chunks(xs, chunk_size):
+    """Yields lists of up to chunk_size consecutive elements of the iterable xs"""
+    chunk = []
+    for x in xs:
+        chunk.append(x)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
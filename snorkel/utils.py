@@ -6,6 +6,9 @@ from builtins import *
 
 import re
 import sys
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 import scipy.sparse as sparse
 
@@ -37,6 +40,61 @@ class ProgressBar(object):
         sys.stdout.flush()
 
 
+class LRUCache(object):
+    """A dict-like cache of up to maxsize items, which evicts the least recently used item when full"""
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data    = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        # Move the item to the most recently used end
+        value = self.data.pop(key)
+        self.data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def get(self, key, default=None):
+        return self[key] if key in self.data else default
+
+    def clear(self):
+        self.data.clear()
+
+
+# The LRUCaches of values computed from contexts, e.g. by feature functions; see context_cache
+_context_caches = []
+
+
+def context_cache(maxsize=128):
+    """
+    Returns a new LRUCache for values computed from contexts, which is cleared, along with the other
+    such caches, by clear_context_caches
+    """
+    cache = LRUCache(maxsize)
+    _context_caches.append(cache)
+    return cache
+
+
+def clear_context_caches():
+    """
+    Clears the caches returned by context_cache. Each UDF run calls this when it starts, since the
+    contexts may have changed since the last run while keeping their ids, e.g. if the corpus was cleared
+    and parsed again.
+    """
+    for cache in _context_caches:
+        cache.clear()
+
+
 def get_ORM_instance(ORM_class, session, instance):
     """
     Given an ORM class and *either an instance of this class, or the name attribute of an instance
@@ -89,12 +147,100 @@ def sparse_abs(X):
     return X_abs
 
 
+# Number of rows of a label matrix per block processed by label_matrix_stats
+LF_STATS_BLOCK_SIZE = 100000
+
+
+def label_matrix_stats(L, labels=None, n_threads=1, block_size=LF_STATS_BLOCK_SIZE):
+    """
+    Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate, and
+    optionally N gold labels in {-1,0,1}, computes the counts behind the LF and candidate statistics in
+    a single pass over the CSR arrays of L, in blocks of block_size rows.
+
+    If n_threads > 1, the blocks are processed by that many threads (NumPy releases the GIL for most of
+    the work).
+
+    Returns a dict of:
+        * n: the number of candidates N
+        * coverage, overlaps, conflicts: M-dim arrays of the number of candidates that each LF labels,
+          labels along with other LFs, and labels along with other LFs giving a different label
+        * candidate_coverage, candidate_overlap, candidate_conflict: the number of candidates with > 0
+          labels, with > 1 labels, and with > 1 labels which are not all equal
+        * tp, fp, tn, fn: if labels is provided, M-dim arrays of the number of candidates that each LF
+          labels 1 or -1, with gold label 1 or -1
+    """
+    L = sparse.csr_matrix(L)
+    if not L.has_canonical_format:
+        L = L.copy()
+        L.sum_duplicates()
+    if labels is not None:
+        labels = np.ravel(labels.todense() if sparse.issparse(labels) else labels)
+    blocks = [(L, labels, i, min(i + block_size, L.shape[0])) for i in range(0, L.shape[0], block_size)]
+
+    # The blocks are vectorized NumPy operations run in threads, rather than numba kernels: snorkel.learning
+    # uses numba, but snorkel.utils is imported by the whole package (the UDFs, annotations, viewer), which
+    # would then need numba and pay its compile time on first use
+    if n_threads is not None and n_threads > 1 and len(blocks) > 1:
+        pool = ThreadPool(min(n_threads, len(blocks)))
+        try:
+            counts = pool.map(_label_matrix_block_stats, blocks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        counts = [_label_matrix_block_stats(block) for block in blocks]
+
+    stats = {'n': L.shape[0]}
+    for key in ['coverage', 'overlaps', 'conflicts'] + (['tp', 'fp', 'tn', 'fn'] if labels is not None else []):
+        stats[key] = sum((c[key] for c in counts), np.zeros(L.shape[1], dtype=np.int64))
+    for key in ['candidate_coverage', 'candidate_overlap', 'candidate_conflict']:
+        stats[key] = sum(c[key] for c in counts)
+    return stats
+
+
+def _label_matrix_block_stats(args):
+    """Computes the label_matrix_stats counts of the rows [start, end) of the CSR matrix L"""
+    L, labels, start, end = args
+    M      = L.shape[1]
+    lo, hi = L.indptr[start], L.indptr[end]
+    data   = L.data[lo:hi]
+    cols   = L.indices[lo:hi]
+    rows   = np.repeat(np.arange(end - start), np.diff(L.indptr[start:end + 1]))
+
+    # Explicitly stored zeros are not labels
+    nz = data != 0
+    data, cols, rows = data[nz], cols[nz], rows[nz]
+
+    # A candidate has conflicting labels if its smallest and largest labels differ; the labels of each
+    # row are contiguous, so these are reduced over the runs of equal row numbers
+    n_labels = np.bincount(rows, minlength=end - start)
+    overlap  = n_labels > 1
+    conflict = np.zeros(end - start, dtype=bool)
+    if len(rows) > 0:
+        runs = np.flatnonzero(np.concatenate([[True], rows[1:] != rows[:-1]]))
+        conflict[rows[runs]] = np.minimum.reduceat(data, runs) != np.maximum.reduceat(data, runs)
+
+    counts = {
+        'coverage'           : np.bincount(cols, minlength=M),
+        'overlaps'           : np.bincount(cols[overlap[rows]], minlength=M),
+        'conflicts'          : np.bincount(cols[conflict[rows]], minlength=M),
+        'candidate_coverage' : int(np.count_nonzero(n_labels)),
+        'candidate_overlap'  : int(np.count_nonzero(overlap)),
+        'candidate_conflict' : int(np.count_nonzero(conflict)),
+    }
+    if labels is not None:
+        gold = labels[start:end][rows]
+        for key, lf_label, gold_label in [('tp', 1, 1), ('fp', 1, -1), ('tn', -1, -1), ('fn', -1, 1)]:
+            counts[key] = np.bincount(cols[(data == lf_label) & (gold == gold_label)], minlength=M)
+    return counts
+
+
 def matrix_coverage(L):
     """
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
     Return the **fraction of candidates that each LF labels.**
     """
-    return np.ravel(sparse_nonzero(L).sum(axis=0) / float(L.shape[0]))
+    return label_matrix_stats(L)['coverage'] / float(L.shape[0])
 
 
 def matrix_overlaps(L):
@@ -102,49 +248,27 @@ def matrix_overlaps(L):
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
     Return the **fraction of candidates that each LF _overlaps with other LFs on_.**
     """
-    L_nonzero = sparse_nonzero(L)
-    return np.ravel(np.where(L_nonzero.sum(axis=1) > 1, 1, 0).T * L_nonzero / float(L.shape[0]))
+    return label_matrix_stats(L)['overlaps'] / float(L.shape[0])
 
 def matrix_conflicts(L):
     """
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
     Return the **fraction of candidates that each LF _conflicts with other LFs on_.**
     """
-    B = L.copy()
-    if not sparse.issparse(B):
-        for row in range(B.shape[0]):
-            if np.unique(np.array(B[row][np.nonzero(B[row])])).size == 1:
-                B[row] = 0
-        return matrix_coverage(sparse_nonzero(B))
-    if not (sparse.isspmatrix_csc(B) or sparse.isspmatrix_lil(B) or sparse.isspmatrix_csr(B)):
-        raise ValueError("Only supports CSR/CSC and LIL matrices")
-    if sparse.isspmatrix_csc(B) or sparse.isspmatrix_lil(B):
-        B = B.tocsr()
-    for row in range(B.shape[0]):
-        if np.unique(B.getrow(row).data).size == 1:
-            B.data[B.indptr[row]:B.indptr[row+1]] = 0
-    return matrix_coverage(sparse_nonzero(B))
+    return label_matrix_stats(L)['conflicts'] / float(L.shape[0])
 
 
 def matrix_tp(L, labels):
-    return np.ravel([
-        np.sum(np.ravel((L[:, j] == 1).todense()) * (labels == 1)) for j in range(L.shape[1])
-    ])
+    return label_matrix_stats(L, labels)['tp']
 
 def matrix_fp(L, labels):
-    return np.ravel([
-        np.sum(np.ravel((L[:, j] == 1).todense()) * (labels == -1)) for j in range(L.shape[1])
-    ])
+    return label_matrix_stats(L, labels)['fp']
 
 def matrix_tn(L, labels):
-    return np.ravel([
-        np.sum(np.ravel((L[:, j] == -1).todense()) * (labels == -1)) for j in range(L.shape[1])
-    ])
+    return label_matrix_stats(L, labels)['tn']
 
 def matrix_fn(L, labels):
-    return np.ravel([
-        np.sum(np.ravel((L[:, j] == -1).todense()) * (labels == 1)) for j in range(L.shape[1])
-    ])
+    return label_matrix_stats(L, labels)['fn']
 
 def get_as_dict(x):
     """Return an object as a dictionary of its attributes"""
@@ -0,0 +1,83 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import os
+import tempfile
+import unittest
+
+# Unless another database is configured, the tests use a new SQLite database rather than snorkel.db
+if not os.environ.get('SNORKELDB'):
+    os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'snorkel.db')
+
+from snorkel.features.context_features import get_context_token_counts
+from snorkel.models import Document, Sentence, SnorkelSession
+from snorkel.udf import UDF, UDFRunner
+
+
+class TokenCountUDF(UDF):
+    """Collects the unigram counts of the input contexts"""
+    counts = []
+
+    def apply(self, x, **kwargs):
+        self.counts.append(get_context_token_counts(x, 'words', 1))
+        return []
+
+
+class TestContextTokenCounts(unittest.TestCase):
+
+    def setUp(self):
+        self.session = SnorkelSession()
+        self.names   = []
+
+    def tearDown(self):
+        self.session.rollback()
+        for doc in self.session.query(Document).filter(Document.name.in_(self.names)):
+            self.session.delete(doc)
+        self.session.commit()
+        self.session.close()
+
+    def _add_document(self, name, texts):
+        """Adds and commits a Document with one Sentence per text"""
+        self.names.append(name)
+        doc = Document(name=name, stable_id='%s::document:0:0' % name, meta={})
+        for i, text in enumerate(texts):
+            words = text.split(' ')
+            offsets = [sum(len(w) + 1 for w in words[:j]) for j in range(len(words))]
+            Sentence(document=doc, position=i, text=text, words=words, char_offsets=offsets,
+                     abs_char_offsets=offsets, stable_id='%s::sentence:%s:%s' % (name, i, i))
+        self.session.add(doc)
+        self.session.commit()
+        return doc
+
+    def _apply(self, context):
+        """Returns the unigram counts of context, as computed in a UDF run"""
+        UDFRunner(TokenCountUDF).apply([context], clear=False, progress_bar=False)
+        return TokenCountUDF.counts[-1]
+
+    def test_counts(self):
+        doc = self._add_document('context_features_counts', ['a b a', 'b c'])
+        self.assertEqual(get_context_token_counts(doc, 'words', 1), {'a': 2, 'b': 2, 'c': 1})
+        self.assertEqual(get_context_token_counts(doc, 'words', 2),
+                         {'a': 2, 'b': 2, 'c': 1, 'a b': 1, 'b a': 1, 'b c': 1})
+        self.assertEqual(get_context_token_counts(doc.sentences[1], 'words', 1), {'b': 1, 'c': 1})
+
+    def test_reparsed_corpus(self):
+        doc = self._add_document('context_features_test', ['a b a'])
+        self.assertEqual(self._apply(doc), {'a': 2, 'b': 1})
+        self.assertEqual(self._apply(doc.sentences[0]), {'a': 2, 'b': 1})
+
+        # The document is parsed again with other tokens; its contexts keep their stable ids, and with
+        # SQLite, their ids
+        self.session.delete(doc)
+        self.session.commit()
+        self.names.remove('context_features_test')
+        doc = self._add_document('context_features_test', ['x y'])
+        self.assertEqual(self._apply(doc), {'x': 1, 'y': 1})
+        self.assertEqual(self._apply(doc.sentences[0]), {'x': 1, 'y': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import os
+import tempfile
+import unittest
+
+# Unless another database is configured, the tests use a new SQLite database rather than snorkel.db
+if not os.environ.get('SNORKELDB'):
+    os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'snorkel.db')
+
+from snorkel.features import relative_features
+from snorkel.features.relative_features import get_sentence_dict, get_sentence_xmltree
+from snorkel.models import Document, Sentence, SnorkelSession
+from snorkel.udf import UDF, UDFRunner
+from snorkel.utils import clear_context_caches
+
+
+class XMLTreeUDF(UDF):
+    """Collects the XML trees of the input Sentences"""
+    trees = []
+
+    def apply(self, x, **kwargs):
+        self.trees.append(get_sentence_xmltree(x))
+        return []
+
+
+class TestSentenceXMLTree(unittest.TestCase):
+
+    def setUp(self):
+        self.session = SnorkelSession()
+
+        # The trees are stood in for by the words, which is enough to tell the sentences apart
+        self.corenlp_to_xmltree = relative_features.corenlp_to_xmltree
+        relative_features.corenlp_to_xmltree = lambda s: list(s['words'])
+        XMLTreeUDF.trees = []
+        clear_context_caches()
+
+    def tearDown(self):
+        relative_features.corenlp_to_xmltree = self.corenlp_to_xmltree
+        self.session.rollback()
+        for doc in self.session.query(Document).filter(Document.name == 'relative_features_test'):
+            self.session.delete(doc)
+        self.session.commit()
+        self.session.close()
+
+    def _add_sentence(self, text):
+        """Adds and commits a Document with a single Sentence, and returns the Sentence"""
+        words    = text.split(' ')
+        offsets  = [sum(len(w) + 1 for w in words[:j]) for j in range(len(words))]
+        doc      = Document(name='relative_features_test', stable_id='relative_features_test::document:0:0',
+                            meta={})
+        sentence = Sentence(document=doc, position=0, text=text, words=words, char_offsets=offsets,
+                            abs_char_offsets=offsets, dep_parents=[0] * len(words),
+                            stable_id='relative_features_test::sentence:0:0')
+        self.session.add(doc)
+        self.session.commit()
+        return sentence
+
+    def _apply(self, sentence):
+        UDFRunner(XMLTreeUDF).apply([sentence], clear=False, progress_bar=False)
+        return XMLTreeUDF.trees[-1]
+
+    def test_cached(self):
+        sentence = self._add_sentence('a b')
+        tree     = get_sentence_xmltree(sentence)
+        self.assertEqual(tree, ['a', 'b'])
+        self.assertIs(get_sentence_xmltree(sentence), tree)
+
+    def test_sentence_dict(self):
+        sentence  = self._add_sentence('a b')
+        sent_dict = get_sentence_dict(sentence)
+        self.assertEqual(sent_dict['words'], ['a', 'b'])
+        self.assertIs(get_sentence_dict(sentence), sent_dict)
+
+        # The dict is rebuilt in a new UDF run
+        self._apply(sentence)
+        self.assertIsNot(get_sentence_dict(sentence), sent_dict)
+
+    def test_reparsed_sentence(self):
+        sentence = self._add_sentence('a b')
+        self.assertEqual(self._apply(sentence), ['a', 'b'])
+
+        # The document is parsed again with other words; its sentence keeps its stable id, and with
+        # SQLite, its id
+        self.session.delete(sentence.document)
+        self.session.commit()
+        sentence = self._add_sentence('x y z')
+        self.assertEqual(self._apply(sentence), ['x', 'y', 'z'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import unittest
+
+import numpy as np
+from scipy import sparse
+
+from snorkel.learning.utils import LF_pairwise_stats
+
+
+class TestLFPairwiseStats(unittest.TestCase):
+
+    def setUp(self):
+        self.L = sparse.csr_matrix(np.array([
+            [ 1,  1,  0],   # LFs 0 and 1 agree
+            [ 1, -1, -1],   # LF 0 disagrees with LFs 1 and 2, which agree
+            [ 0, -1,  1],   # LFs 1 and 2 disagree
+            [ 9,  0,  1],
+            [-1,  0, -1],   # LFs 0 and 2 agree
+        ]))
+
+        # An explicitly stored zero is not a label
+        self.L.data[self.L.data == 9] = 0
+
+        self.co_coverage   = np.array([[3, 2, 2], [2, 3, 2], [2, 2, 4]])
+        self.agreements    = np.array([[3, 1, 1], [1, 3, 1], [1, 1, 4]])
+        self.disagreements = np.array([[0, 1, 1], [1, 0, 1], [1, 1, 0]])
+
+    def assertPairwiseEqual(self, stats, scale=1.0):
+        co_coverage, agreements, disagreements = stats
+        for X in stats:
+            self.assertTrue(sparse.issparse(X))
+        np.testing.assert_allclose(co_coverage.toarray(), self.co_coverage / scale)
+        np.testing.assert_allclose(agreements.toarray(), self.agreements / scale)
+        np.testing.assert_allclose(disagreements.toarray(), self.disagreements / scale)
+
+    def test_pairwise_stats(self):
+        self.assertPairwiseEqual(LF_pairwise_stats(self.L))
+
+    def test_blocks(self):
+        self.assertPairwiseEqual(LF_pairwise_stats(self.L, block_size=2))
+
+    def test_normalize(self):
+        self.assertPairwiseEqual(LF_pairwise_stats(self.L, normalize=True), scale=5.0)
+
+    def test_categorical(self):
+        L = sparse.csr_matrix(np.array([[1, 2, 1], [3, 3, 0], [2, 0, 2]]))
+        co_coverage, agreements, disagreements = LF_pairwise_stats(L)
+        np.testing.assert_array_equal(co_coverage.toarray(), [[3, 2, 2], [2, 2, 1], [2, 1, 2]])
+        np.testing.assert_array_equal(agreements.toarray(), [[3, 1, 2], [1, 2, 0], [2, 0, 2]])
+        np.testing.assert_array_equal(disagreements.toarray(), [[0, 1, 0], [1, 0, 1], [0, 1, 0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
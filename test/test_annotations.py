@@ -0,0 +1,343 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+# Unless another database is configured, the tests use a new SQLite database rather than snorkel.db
+if not os.environ.get('SNORKELDB'):
+    os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'snorkel.db')
+
+from snorkel import annotations
+from snorkel.annotations import (
+    HASH_KEY_NAME, FeatureAnnotator, IdIndex, InverseIdIndex, csr_LabelMatrix, feature_hash, load_marginals, load_matrix,
+    reserve_hash_keys, save_marginals
+)
+from snorkel.models import (
+    Candidate, Document, Feature, FeatureKey, Label, LabelKey, Marginal, Sentence, SnorkelSession, Span,
+    candidate_subclass
+)
+
+class TestIdIndex(unittest.TestCase):
+
+    def setUp(self):
+        # The dicts which the id indexes replace, for unsorted ids
+        self.ids     = [7, 3, 12, 5]
+        self.index   = dict(enumerate(self.ids))
+        self.inverse = dict((cid, i) for i, cid in enumerate(self.ids))
+
+    def test_id_index(self):
+        index = IdIndex(self.ids)
+        self.assertEqual(index, self.index)
+        self.assertEqual(len(index), 4)
+        self.assertEqual([index[i] for i in index], [self.index[i] for i in self.index])
+        self.assertEqual(sorted(index.items()), sorted(self.index.items()))
+        self.assertNotIn(4, index)
+        self.assertIsNone(index.get(-1))
+        self.assertRaises(KeyError, lambda: index[4])
+        self.assertEqual(index.take([2, 0]), {0: 12, 1: 7})
+
+    def test_inverse_id_index(self):
+        for ids in [self.ids, sorted(self.ids), []]:
+            inverse  = InverseIdIndex(ids)
+            expected = dict((cid, i) for i, cid in enumerate(ids))
+            self.assertEqual(inverse, expected)
+            for cid in [3, 4, 5, 7, 12, 13]:
+                self.assertEqual(cid in inverse, cid in expected)
+                self.assertEqual(inverse.get(cid), expected.get(cid))
+            np.testing.assert_array_equal(inverse.lookup([12, 4, 3, 13]),
+                                          [expected.get(cid, -1) for cid in [12, 4, 3, 13]])
+        self.assertRaises(KeyError, lambda: InverseIdIndex(self.ids)[4])
+
+
+# A split and key group which no other data uses, so that the tests can run against any database
+TEST_SPLIT     = 9014
+TEST_KEY_GROUP = 9014
+
+Mention = candidate_subclass('AnnotationsTestMention', ['mention'])
+
+
+def _add_mentions(session, name, words, split):
+    """Adds a Document with one Sentence of words, and a Mention of each word in split"""
+    doc      = Document(name=name, stable_id='%s::document:0:0' % name, meta={})
+    offsets  = list(range(0, 2 * len(words), 2))
+    sentence = Sentence(document=doc, position=0, text=' '.join(words), words=words, char_offsets=offsets,
+                        abs_char_offsets=offsets, stable_id='%s::sentence:0:%s' % (name, 2 * len(words) - 2))
+    for i in range(len(words)):
+        span = Span(sentence=sentence, char_start=2 * i, char_end=2 * i,
+                    stable_id='%s::span:%s:%s' % (name, 2 * i, 2 * i))
+        session.add(Mention(mention=span, split=split))
+
+
+class TestMatrixCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        _add_mentions(cls.session, 'annotations_test', ['a', 'b', 'c', 'd', 'e', 'f'], TEST_SPLIT)
+        cls.key       = LabelKey(name='annotations_test_lf', group=TEST_KEY_GROUP)
+        cls.other_key = LabelKey(name='annotations_test_other_lf', group=TEST_KEY_GROUP)
+        cls.session.add_all([cls.key, cls.other_key])
+        cls.session.commit()
+        cls.cids = [c.id for c in cls.session.query(Mention).filter(Mention.split == TEST_SPLIT)
+                                                           .order_by(Mention.id)]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.query(Label).filter(Label.key_id.in_([cls.key.id, cls.other_key.id]))\
+                                .delete(synchronize_session=False)
+        cls.session.query(LabelKey).filter(LabelKey.group == TEST_KEY_GROUP).delete(synchronize_session=False)
+        cls.session.query(Candidate).filter(Candidate.split == TEST_SPLIT).delete(synchronize_session=False)
+        cls.session.delete(cls.session.query(Document).filter(Document.name == 'annotations_test').one())
+        cls.session.commit()
+        cls.session.close()
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self._set_values({})
+        shutil.rmtree(self.cache_dir)
+
+    def _set_values(self, values):
+        """Replaces the test Labels by the values in a dict of (candidate id, key id) -> value"""
+        self.session.query(Label).filter(Label.key_id.in_([self.key.id, self.other_key.id]))\
+                                 .delete(synchronize_session=False)
+        for (cid, kid), value in values.items():
+            self.session.add(Label(candidate_id=cid, key_id=kid, value=value))
+        self.session.commit()
+
+    def _set_labels(self, cids, value=1):
+        self._set_values(dict(((cid, self.key.id), value) for cid in cids))
+
+    def _load(self, cache_dir, cids_query=None):
+        return load_matrix(csr_LabelMatrix, LabelKey, Label, self.session, split=TEST_SPLIT,
+                           key_group=TEST_KEY_GROUP, cache_dir=cache_dir, cids_query=cids_query)
+
+    def _labeled_rows(self, X):
+        return list(np.flatnonzero(np.asarray(X.sum(axis=1)).ravel()))
+
+    def test_cache_hit(self):
+        self._set_labels(self.cids[:3])
+        X = self._load(self.cache_dir)
+
+        # The second load reopens the cached arrays, without loading the annotations
+        load_annotations = annotations._load_annotations
+        annotations._load_annotations = None
+        try:
+            Y = self._load(self.cache_dir)
+        finally:
+            annotations._load_annotations = load_annotations
+        self.assertFalse(Y.data.flags.writeable)
+        self.assertEqual((X != Y).nnz, 0)
+        self.assertEqual((Y != self._load(None)).nnz, 0)
+
+    def test_relabeled_candidates(self):
+        # The same number of labels, with the same key and values, on other candidates
+        self._set_labels(self.cids[:3])
+        self.assertEqual(self._labeled_rows(self._load(self.cache_dir)), [0, 1, 2])
+        self._set_labels(self.cids[3:])
+        self.assertEqual(self._labeled_rows(self._load(self.cache_dir)), [3, 4, 5])
+
+    def test_relabeled_values(self):
+        self._set_labels(self.cids[:3], value=1)
+        self.assertEqual(self._load(self.cache_dir).sum(), 3)
+        self._set_labels(self.cids[:3], value=-1)
+        self.assertEqual(self._load(self.cache_dir).sum(), -3)
+
+    def test_permuted_values(self):
+        # A checkerboard of labels is flipped: the count and the sums of every column are unchanged
+        c0, c1 = self.cids[:2]
+        k0, k1 = self.key.id, self.other_key.id
+        self._set_values({(c0, k0): 1, (c0, k1): -1, (c1, k0): -1, (c1, k1): 1})
+        X = self._load(self.cache_dir)
+        np.testing.assert_array_equal(X.toarray()[:2], [[1, -1], [-1, 1]])
+        self._set_values({(c0, k0): -1, (c0, k1): 1, (c1, k0): 1, (c1, k1): -1})
+        X = self._load(self.cache_dir)
+        np.testing.assert_array_equal(X.toarray()[:2], [[-1, 1], [1, -1]])
+        self.assertEqual((X != self._load(None)).nnz, 0)
+
+    def test_candidate_subsets(self):
+        # The caches of different candidate queries of the same split are kept side by side
+        self._set_labels(self.cids)
+        subset = self.session.query(Mention.id).filter(Mention.split == TEST_SPLIT)\
+                                               .filter(Mention.id.in_(self.cids[:2]))
+        self.assertEqual(self._load(self.cache_dir).shape[0], len(self.cids))
+        self.assertEqual(self._load(self.cache_dir, cids_query=subset).shape[0], 2)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+
+
+# The number of hash bits, the split and the key group of the feature hashing tests
+TEST_HASH_BITS      = 2
+TEST_HASH_SPLIT     = 9020
+TEST_HASH_KEY_GROUP = 9020
+
+
+def _colliding_names(same_sign):
+    """Returns two feature names with the same hash, and the same or opposite signs"""
+    first = {}
+    for i in range(1000):
+        name    = 'feature_%s' % i
+        h, sign = feature_hash(name, TEST_HASH_BITS)
+        if h in first and (first[h][1] == sign) == same_sign:
+            return first[h][0], name
+        first.setdefault(h, (name, sign))
+
+
+def hash_test_features(c):
+    """Features of a Mention of a word w: w itself, 'all', and two pairs of colliding names"""
+    word = c.mention.get_span()
+    yield word, 1
+    yield 'all', 1
+    yield 'all', 1
+    if word in ['a', 'b']:
+        for name in _colliding_names(same_sign=False):
+            yield name, 1
+    if word == 'a':
+        for name in _colliding_names(same_sign=True):
+            yield name, 1
+
+
+class TestFeatureHashing(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        _add_mentions(cls.session, 'annotations_hash_test', ['a', 'b', 'c', 'd'], TEST_HASH_SPLIT)
+        cls.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cids = cls.session.query(Candidate.id).filter(Candidate.split == TEST_HASH_SPLIT)
+        cls.session.query(Feature).filter(Feature.candidate_id.in_(cids.subquery()))\
+                                  .delete(synchronize_session=False)
+        cls.session.query(FeatureKey).filter(FeatureKey.group == TEST_HASH_KEY_GROUP)\
+                                     .delete(synchronize_session=False)
+        cls.session.query(Candidate).filter(Candidate.split == TEST_HASH_SPLIT).delete(synchronize_session=False)
+        cls.session.delete(cls.session.query(Document).filter(Document.name == 'annotations_hash_test').one())
+        cls.session.commit()
+        cls.session.close()
+
+    def _hashed(self, parallelism=None):
+        return FeatureAnnotator(hash_test_features, hash_bits=TEST_HASH_BITS).apply(
+            split=TEST_HASH_SPLIT, key_group=TEST_HASH_KEY_GROUP, parallelism=parallelism, progress_bar=False)
+
+    def test_colliding_names(self):
+        for same_sign in [True, False]:
+            a, b = _colliding_names(same_sign)
+            self.assertEqual(feature_hash(a, TEST_HASH_BITS)[0], feature_hash(b, TEST_HASH_BITS)[0])
+            self.assertEqual(feature_hash(a, TEST_HASH_BITS)[1] == feature_hash(b, TEST_HASH_BITS)[1], same_sign)
+
+    def test_hashed_matrix(self):
+        # The hashed matrix is the matrix with one key per feature name, projected onto the hashed keys
+        candidates = self.session.query(Mention).filter(Mention.split == TEST_HASH_SPLIT).order_by(Mention.id)
+        expected   = np.zeros((4, 1 << TEST_HASH_BITS))
+        for i, c in enumerate(candidates):
+            features = {}
+            for name, value in hash_test_features(c):
+                features.setdefault(name, value)
+            for name, value in features.items():
+                h, sign = feature_hash(name, TEST_HASH_BITS)
+                expected[i, h] += sign * value
+        for parallelism in [None, 2]:
+            X = self._hashed(parallelism)
+            self.assertEqual(X.shape, (4, 1 << TEST_HASH_BITS))
+            np.testing.assert_allclose(X.toarray(), expected)
+
+            # Colliding features whose values cancel out are not stored
+            self.assertEqual(X.nnz, np.count_nonzero(expected))
+
+    def test_reserve_hash_keys(self):
+        # Other keys of the group are deleted, with their Features; the hashed keys are in order of hash
+        key = FeatureKey(name='annotations_hash_test_stale', group=TEST_HASH_KEY_GROUP)
+        self.session.add(key)
+        self.session.commit()
+        cid = self.session.query(Candidate.id).filter(Candidate.split == TEST_HASH_SPLIT).first()[0]
+        key_id = key.id
+        self.session.add(Feature(candidate_id=cid, key_id=key_id, value=1))
+        self.session.commit()
+        reserve_hash_keys(self.session, Feature, FeatureKey, TEST_HASH_KEY_GROUP, TEST_HASH_BITS)
+        self.session.commit()
+        names = [name for name, in self.session.query(FeatureKey.name)
+                                               .filter(FeatureKey.group == TEST_HASH_KEY_GROUP)
+                                               .order_by(FeatureKey.id)]
+        self.assertEqual(names, [HASH_KEY_NAME % h for h in range(1 << TEST_HASH_BITS)])
+        self.assertEqual(self.session.query(Feature).filter(Feature.key_id == key_id).count(), 0)
+
+
+
+# The split of the marginals tests
+TEST_MARGINALS_SPLIT = 9017
+
+
+class TestMarginals(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        _add_mentions(cls.session, 'annotations_marginals_test', ['a', 'b', 'c', 'd', 'e'], TEST_MARGINALS_SPLIT)
+        cls.session.commit()
+        cls.candidates = cls.session.query(Mention).filter(Mention.split == TEST_MARGINALS_SPLIT)\
+                                                   .order_by(Mention.id).all()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.query(Candidate).filter(Candidate.split == TEST_MARGINALS_SPLIT)\
+                                    .delete(synchronize_session=False)
+        cls.session.delete(cls.session.query(Document).filter(Document.name == 'annotations_marginals_test').one())
+        cls.session.commit()
+        cls.session.close()
+
+    def setUp(self):
+        # Small batches, so that the deletes and inserts are split into several statements
+        self.batch_sizes = annotations.PREFETCH_BATCH_SIZE, annotations.MARGINALS_BATCH_SIZE
+        annotations.PREFETCH_BATCH_SIZE, annotations.MARGINALS_BATCH_SIZE = 2, 3
+
+    def tearDown(self):
+        annotations.PREFETCH_BATCH_SIZE, annotations.MARGINALS_BATCH_SIZE = self.batch_sizes
+        cids = [c.id for c in self.candidates]
+        self.session.query(Marginal).filter(Marginal.candidate_id.in_(cids)).delete(synchronize_session=False)
+        self.session.commit()
+
+    def _stored(self, training=True):
+        """Returns the stored marginals as a dict of (candidate position, value) -> probability"""
+        position = dict((c.id, i) for i, c in enumerate(self.candidates))
+        q = self.session.query(Marginal.candidate_id, Marginal.value, Marginal.probability)\
+                        .filter(Marginal.candidate_id.in_(list(position.keys())))\
+                        .filter(Marginal.training == training)
+        return dict(((position[cid], k), p) for cid, k, p in q)
+
+    def test_save_and_load(self):
+        save_marginals(self.session, self.candidates, [0.1, 0.5, 0.0, 0.9, 1.0])
+        self.assertEqual(self._stored(), {(0, 1): 0.1, (1, 1): 0.5, (3, 1): 0.9, (4, 1): 1.0})
+        np.testing.assert_allclose(load_marginals(self.session, split=TEST_MARGINALS_SPLIT),
+                                   [0.1, 0.5, 0.0, 0.9, 1.0])
+
+        # With X, the marginals are collated with it, as by a lookup of each candidate
+        X = [self.candidates[i] for i in [3, 0, 2]]
+        np.testing.assert_allclose(load_marginals(self.session, X=X, split=TEST_MARGINALS_SPLIT), [0.9, 0.1, 0.0])
+
+    def test_save_existing(self):
+        # Saving the marginals of some candidates replaces theirs only, and only of the same type
+        save_marginals(self.session, self.candidates, [0.1, 0.2, 0.3, 0.4, 0.5])
+        save_marginals(self.session, self.candidates, [0.9, 0.9, 0.9, 0.9, 0.9], training=False)
+        save_marginals(self.session, self.candidates[1:4], [0.6, 0.0, 0.8])
+        self.assertEqual(self._stored(), {(0, 1): 0.1, (1, 1): 0.6, (3, 1): 0.8, (4, 1): 0.5})
+        self.assertEqual(self._stored(training=False), dict(((i, 1), 0.9) for i in range(5)))
+
+    def test_save_empty(self):
+        save_marginals(self.session, self.candidates, [0.1, 0.2, 0.3, 0.4, 0.5])
+        save_marginals(self.session, [], [])
+        self.assertEqual(len(self._stored()), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
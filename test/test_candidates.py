@@ -0,0 +1,134 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import os
+import tempfile
+import unittest
+
+# Unless another database is configured, the tests use a new SQLite database rather than snorkel.db
+if not os.environ.get('SNORKELDB'):
+    os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'snorkel.db')
+
+from sqlalchemy.sql import select
+
+from snorkel import candidates
+from snorkel.candidates import CandidateArgsCache, SpanIdCache, load_candidate_args, load_span_ids
+from snorkel.models import Document, Sentence, SnorkelSession, Span, TemporarySpan, candidate_subclass
+
+Pair = candidate_subclass('CandidatesTestPair', ['a', 'b'])
+
+
+class CandidatesTestCase(unittest.TestCase):
+    """
+    Three Sentences of four words: the first has Spans of all its words and Pairs of consecutive words,
+    the second has Spans of its first two words, and the third none
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        doc = Document(name='candidates_test', stable_id='candidates_test::document:0:0', meta={})
+        for i in range(3):
+            Sentence(document=doc, position=i, text='a b c d', words=['a', 'b', 'c', 'd'],
+                     char_offsets=[0, 2, 4, 6], abs_char_offsets=[8 * i + j for j in [0, 2, 4, 6]],
+                     stable_id='candidates_test::sentence:%s:%s' % (8 * i, 8 * i + 6))
+        cls.session.add(doc)
+        cls.session.commit()
+        cls.sentences = list(doc.sentences)
+        spans = [cls._add_span(cls.sentences[0], i) for i in range(4)]
+        spans += [cls._add_span(cls.sentences[1], i) for i in range(2)]
+        cls.session.add_all([Pair(a=spans[i], b=spans[i + 1]) for i in range(3)])
+        cls.session.commit()
+
+    @classmethod
+    def _add_span(cls, sentence, i):
+        span = Span(sentence=sentence, char_start=2 * i, char_end=2 * i,
+                    stable_id=TemporarySpan(sentence, 2 * i, 2 * i).get_stable_id())
+        cls.session.add(span)
+        return span
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.query(Pair).delete(synchronize_session=False)
+        cls.session.delete(cls.session.query(Document).filter(Document.name == 'candidates_test').one())
+        cls.session.commit()
+        cls.session.close()
+
+    def setUp(self):
+        # Batches of one id, so that the prefetch queries are split into several statements
+        self.batch_size = candidates.PREFETCH_BATCH_SIZE
+        candidates.PREFETCH_BATCH_SIZE = 1
+
+    def tearDown(self):
+        candidates.PREFETCH_BATCH_SIZE = self.batch_size
+
+    def _temporary_spans(self):
+        return [TemporarySpan(s, 2 * i, 2 * i) for s in self.sentences for i in range(4)]
+
+
+class TestSpanIds(CandidatesTestCase):
+
+    def test_load_span_ids(self):
+        # The same ids as loaded by each TemporarySpan on its own
+        expected = dict((tc.get_stable_id(), tc.load_id(self.session)) for tc in self._temporary_spans())
+        expected = dict((k, v) for k, v in expected.items() if v is not None)
+        self.assertEqual(len(expected), 6)
+        self.assertEqual(load_span_ids(self.session, [s.id for s in self.sentences]), expected)
+        self.assertEqual(load_span_ids(self.session, []), {})
+
+    def test_span_id_cache(self):
+        # A prefetched chunk of some of the Sentences; the others fall back to a query per TemporarySpan
+        cache = SpanIdCache()
+        cache.prefetch(self.session, self.sentences[:2])
+        for tc in self._temporary_spans():
+            self.assertEqual(cache.load_id(self.session, tc),
+                             TemporarySpan(tc.sentence, tc.char_start, tc.char_end).load_id(self.session))
+
+    def test_empty_chunk(self):
+        cache = SpanIdCache()
+        cache.prefetch(self.session, [])
+        tc = self._temporary_spans()[0]
+        self.assertEqual(cache.load_id(self.session, tc), TemporarySpan(tc.sentence, 0, 0).load_id(self.session))
+        self.assertIsNotNone(tc.id)
+
+
+
+class TestCandidateArgs(CandidatesTestCase):
+
+    def _exists(self, arg_ids):
+        """Whether a Pair with arg_ids exists, queried on its own"""
+        q = select([Pair.id]).where(Pair.a_id == arg_ids[0]).where(Pair.b_id == arg_ids[1])
+        return self.session.execute(q).first() is not None
+
+    def _arg_ids(self, sentence):
+        span_ids = sorted(span.id for span in sentence.spans)
+        return [(a, b) for a in span_ids for b in span_ids if a != b]
+
+    def test_load_candidate_args(self):
+        expected = set(arg_ids for s in self.sentences for arg_ids in self._arg_ids(s) if self._exists(arg_ids))
+        self.assertEqual(len(expected), 3)
+        self.assertEqual(load_candidate_args(self.session, Pair, [s.id for s in self.sentences]), expected)
+        self.assertEqual(load_candidate_args(self.session, Pair, []), set())
+
+    def test_candidate_args_cache(self):
+        cache = CandidateArgsCache(Pair)
+        cache.prefetch(self.sentences[:2])
+        for sentence in self.sentences:
+            for arg_ids in self._arg_ids(sentence):
+                self.assertEqual(cache.exists(self.session, sentence, arg_ids), self._exists(arg_ids))
+
+                # New Candidates of the prefetched chunk are recorded, so that they are not extracted twice
+                if sentence in self.sentences[:2]:
+                    self.assertTrue(cache.exists(self.session, sentence, arg_ids))
+
+    def test_empty_chunk(self):
+        cache = CandidateArgsCache(Pair)
+        cache.prefetch([])
+        for arg_ids in self._arg_ids(self.sentences[0]):
+            self.assertEqual(cache.exists(self.session, self.sentences[0], arg_ids), self._exists(arg_ids))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import os
+import tempfile
+import unittest
+
+# Unless another database is configured, the tests use a new SQLite database rather than snorkel.db
+if not os.environ.get('SNORKELDB'):
+    os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'snorkel.db')
+
+from snorkel.models import Document, Sentence, SnorkelSession, StableLabel
+from snorkel.udf import UDF, UDFRunner, Row, WriteBuffer, config_hash
+
+
+class StableLabelUDF(UDF):
+    """Outputs a StableLabel Row for each input name"""
+    def apply(self, x, **kwargs):
+        yield Row(StableLabel, context_stable_ids=x, annotator_name='udf_test', value=len(x))
+
+
+class StableLabelRunner(UDFRunner):
+    def __init__(self, udf_class=StableLabelUDF):
+        super(StableLabelRunner, self).__init__(udf_class)
+
+    def clear(self, session, **kwargs):
+        session.query(StableLabel).filter(StableLabel.annotator_name == 'udf_test')\
+                                  .delete(synchronize_session=False)
+
+
+class RelabelUDF(UDF):
+    """Changes the value of the persistent StableLabel of each input name"""
+    def apply(self, x, **kwargs):
+        label = self.session.query(StableLabel).filter(StableLabel.context_stable_ids == x).one()
+        label.value += 1
+        return []
+
+
+class SessionHolder(object):
+    """An object which holds a session and refers to itself"""
+    def __init__(self):
+        self.session = SnorkelSession()
+        self.me      = self
+
+
+class TestConfigHash(unittest.TestCase):
+
+    def test_cycles(self):
+        holder = SessionHolder()
+        lf     = lambda c: holder.session is not None
+        self.assertEqual(config_hash([lf, holder]), config_hash([lf, holder]))
+        nested = []
+        nested.append(nested)
+        config_hash(nested)
+
+    def test_functions(self):
+        # Functions are told apart by their code, not only by their names
+        lfs = [lambda c: 1, lambda c: -1]
+        self.assertNotEqual(config_hash(lfs[0]), config_hash(lfs[1]))
+
+
+class TestWriteBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.session = SnorkelSession(expire_on_commit=False)
+        self.buffer  = WriteBuffer(self.session)
+
+    def tearDown(self):
+        self.session.rollback()
+        self.session.query(StableLabel).filter(StableLabel.annotator_name == 'udf_test')\
+                                       .delete(synchronize_session=False)
+        for doc in self.session.query(Document).filter(Document.name.like('udf_test%')):
+            self.session.delete(doc)
+        self.session.commit()
+        self.session.close()
+
+    def _sentence(self, doc, position):
+        return Sentence(document=doc, position=position, text='a', words=['a'], char_offsets=[0],
+                        abs_char_offsets=[0], stable_id='%s::sentence:%s:%s' % (doc.name, position, position))
+
+    def test_explicit_none(self):
+        # Columns explicitly set to None are written as the ORM writes them
+        for name, split in [('udf_test_orm', None), ('udf_test_orm_default', 1)]:
+            self.session.add(StableLabel(context_stable_ids=name, annotator_name='udf_test', split=split, value=1))
+        self.session.commit()
+        self.buffer.add(StableLabel(context_stable_ids='udf_test_buffer', annotator_name='udf_test', split=None,
+                                    value=1))
+        self.buffer.add(StableLabel(context_stable_ids='udf_test_buffer_default', annotator_name='udf_test',
+                                    split=1, value=1))
+        self.buffer.flush()
+        splits = dict(self.session.query(StableLabel.context_stable_ids, StableLabel.split)
+                                  .filter(StableLabel.annotator_name == 'udf_test'))
+        self.assertEqual(splits['udf_test_buffer'], splits['udf_test_orm'])
+        self.assertEqual(splits['udf_test_buffer_default'], 1)
+
+    def test_shared_parent(self):
+        # A new Document referenced by Sentences written in different flushes is inserted once
+        doc = Document(name='udf_test_shared', stable_id='udf_test_shared::document:0:0', meta={})
+        self.buffer.add(self._sentence(doc, 0))
+        self.buffer.flush()
+        self.buffer.add(self._sentence(doc, 1))
+        self.buffer.flush()
+        docs = self.session.query(Document).filter(Document.name == 'udf_test_shared').all()
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(sorted(s.position for s in docs[0].sentences), [0, 1])
+
+    def test_discard(self):
+        # The Rows of discarded objects are dropped, so that they are converted again if added later
+        doc  = Document(name='udf_test_discard', stable_id='udf_test_discard::document:0:0', meta={})
+        mark = self.buffer.mark()
+        self.buffer.add(self._sentence(doc, 0))
+        self.buffer.discard(mark)
+        self.buffer.add(self._sentence(doc, 1))
+        self.buffer.flush()
+        docs = self.session.query(Document).filter(Document.name == 'udf_test_discard').all()
+        self.assertEqual(len(docs), 1)
+        self.assertEqual([s.position for s in docs[0].sentences], [1])
+
+
+
+class TestSingleWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.session = SnorkelSession()
+        self.names   = ['udf_test_%s' % ('x' * i) for i in range(1, 50)]
+
+    def tearDown(self):
+        StableLabelRunner().clear(self.session)
+        self.session.commit()
+        self.session.close()
+
+    def _labels(self):
+        return sorted(self.session.query(StableLabel.context_stable_ids, StableLabel.value)
+                                  .filter(StableLabel.annotator_name == 'udf_test'))
+
+    def test_rows(self):
+        # The Rows written by this process are those the UDF writes itself when run single-threaded
+        StableLabelRunner().apply(self.names, progress_bar=False)
+        expected = self._labels()
+        self.assertEqual(len(expected), len(self.names))
+        StableLabelRunner().apply(self.names, parallelism=2, single_writer=True, chunk_size=7,
+                                  progress_bar=False)
+        self.assertEqual(self._labels(), expected)
+
+    def test_session_changes(self):
+        StableLabelRunner().apply(self.names, progress_bar=False)
+        with self.assertRaises(RuntimeError) as cm:
+            UDFRunner(RelabelUDF).apply(self.names, clear=False, parallelism=2, single_writer=True,
+                                        progress_bar=False)
+        self.assertIn('single-writer', str(cm.exception))
+        self.assertEqual(set(v for _, v in self._labels()), set(len(x) for x in self.names))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import unittest
+
+import numpy as np
+from scipy import sparse
+
+from snorkel.utils import (
+    label_matrix_stats, matrix_conflicts, matrix_coverage, matrix_fn, matrix_fp, matrix_overlaps, matrix_tn,
+    matrix_tp
+)
+
+
+def _dense_stats(L, labels=None):
+    """Computes the label_matrix_stats counts with plain loops over the rows of the dense matrix L"""
+    N, M  = L.shape
+    stats = dict((key, np.zeros(M, dtype=np.int64)) for key in ['coverage', 'overlaps', 'conflicts'])
+    stats.update({'n': N, 'candidate_coverage': 0, 'candidate_overlap': 0, 'candidate_conflict': 0})
+    for key in ['tp', 'fp', 'tn', 'fn']:
+        stats[key] = np.zeros(M, dtype=np.int64)
+    for i in range(N):
+        lfs = np.flatnonzero(L[i])
+        if len(lfs) > 0:
+            stats['candidate_coverage'] += 1
+            stats['coverage'][lfs]      += 1
+        if len(lfs) > 1:
+            stats['candidate_overlap'] += 1
+            stats['overlaps'][lfs]     += 1
+        if len(set(L[i, lfs])) > 1:
+            stats['candidate_conflict'] += 1
+            stats['conflicts'][lfs]     += 1
+        if labels is not None:
+            for j in lfs:
+                if L[i, j] == 1:
+                    stats['tp' if labels[i] == 1 else 'fp'][j] += labels[i] != 0
+                else:
+                    stats['tn' if labels[i] == -1 else 'fn'][j] += labels[i] != 0
+    return stats
+
+
+def _per_row_conflicts(L):
+    """The fraction of candidates on which each LF conflicts, computed row by row as matrix_conflicts did"""
+    B = L.tocsr(copy=True)
+    for row in range(B.shape[0]):
+        if np.unique(B.getrow(row).data).size == 1:
+            B.data[B.indptr[row]:B.indptr[row+1]] = 0
+    return np.ravel((abs(B) > 0).sum(axis=0) / float(B.shape[0]))
+
+
+def _per_column_counts(L, labels, value, label):
+    """The number of candidates labeled value by each LF with gold label label, column by column"""
+    return np.ravel([np.sum(np.ravel(L[:, [j]].toarray() == value) * (labels == label)) for j in range(L.shape[1])])
+
+
+class TestLabelMatrixStats(unittest.TestCase):
+
+    def setUp(self):
+        rs          = np.random.RandomState(0)
+        self.dense  = rs.choice([-1, 0, 0, 1], size=(200, 7))
+        self.labels = rs.choice([-1, 1], size=200)
+
+        # Explicitly stored zeros are not labels
+        self.L = sparse.csr_matrix(self.dense)
+        self.L.data[::5] = 0
+        self.dense = self.L.toarray()
+
+    def assertStatsEqual(self, stats, expected, labels=True):
+        keys = ['n', 'coverage', 'overlaps', 'conflicts', 'candidate_coverage', 'candidate_overlap',
+                'candidate_conflict'] + (['tp', 'fp', 'tn', 'fn'] if labels else [])
+        for key in keys:
+            np.testing.assert_array_equal(stats[key], expected[key], err_msg=key)
+
+    def test_stats(self):
+        expected = _dense_stats(self.dense, self.labels)
+        self.assertStatsEqual(label_matrix_stats(self.L, self.labels), expected)
+        self.assertStatsEqual(label_matrix_stats(self.L, self.labels, block_size=13), expected)
+        self.assertStatsEqual(label_matrix_stats(self.L, self.labels, n_threads=3, block_size=13), expected)
+        self.assertStatsEqual(label_matrix_stats(self.L), expected, labels=False)
+
+    def test_matrix_functions(self):
+        expected = _dense_stats(self.dense, self.labels)
+        N        = float(self.dense.shape[0])
+        np.testing.assert_allclose(matrix_coverage(self.L), expected['coverage'] / N)
+        np.testing.assert_allclose(matrix_overlaps(self.L), expected['overlaps'] / N)
+        np.testing.assert_allclose(matrix_conflicts(self.L), expected['conflicts'] / N)
+        np.testing.assert_array_equal(matrix_tp(self.L, self.labels), expected['tp'])
+        np.testing.assert_array_equal(matrix_fp(self.L, self.labels), expected['fp'])
+        np.testing.assert_array_equal(matrix_tn(self.L, self.labels), expected['tn'])
+        np.testing.assert_array_equal(matrix_fn(self.L, self.labels), expected['fn'])
+
+    def test_per_row_helpers(self):
+        # Without explicitly stored zeros, the results are those of the earlier row and column loops
+        L = sparse.csr_matrix(self.dense)
+        L.eliminate_zeros()
+        np.testing.assert_allclose(matrix_conflicts(L), _per_row_conflicts(L))
+        np.testing.assert_array_equal(matrix_tp(L, self.labels), _per_column_counts(L, self.labels, 1, 1))
+        np.testing.assert_array_equal(matrix_fp(L, self.labels), _per_column_counts(L, self.labels, 1, -1))
+        np.testing.assert_array_equal(matrix_tn(L, self.labels), _per_column_counts(L, self.labels, -1, -1))
+        np.testing.assert_array_equal(matrix_fn(L, self.labels), _per_column_counts(L, self.labels, -1, 1))
+
+    def test_empty_matrix(self):
+        L     = sparse.csr_matrix((0, 4), dtype=np.int64)
+        stats = label_matrix_stats(L, np.zeros(0))
+        self.assertStatsEqual(stats, _dense_stats(np.zeros((0, 4)), np.zeros(0)))
+        self.assertEqual(stats['coverage'].shape, (4,))
+
+    def test_all_abstain(self):
+        L        = sparse.csr_matrix((50, 4), dtype=np.int64)
+        labels   = np.ones(50)
+        expected = _dense_stats(np.zeros((50, 4)), labels)
+        self.assertStatsEqual(label_matrix_stats(L, labels), expected)
+        self.assertStatsEqual(label_matrix_stats(L, labels, n_threads=2, block_size=7), expected)
+        np.testing.assert_array_equal(matrix_coverage(L), np.zeros(4))
+        np.testing.assert_array_equal(matrix_conflicts(L), np.zeros(4))
+
+
+if __name__ == '__main__':
+    unittest.main()